@@ -1,7 +1,24 @@
 import pygame
+import argparse
+import bisect
+import collections
+import hashlib
+import json
+import math
+import mmap
+import operator
+import os
+import struct
 import sys
+import threading
+import time
 from pygame.locals import *
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 ####################################
 # Constants
 ####################################
@@ -32,42 +49,708 @@ flowerColor = [200, 50, 10]
 
 # Camera
 class Camera:
-    def __init__ (self):
-        self.getValues()
+    def __init__ (self, level):
+        self.level = level
+        level.camera = self
         self.x = 0
         self.y = 0
         self.w = screenSize[0]
         self.h = screenSize[1]
+        self.getValues()
+        self.prevX = self.x
+        self.prevY = self.y
+        self.viewX = self.x
+        self.viewY = self.y
+        self.alpha = 1.0
+        # Screen pixels per world pixel. The view always covers the same
+        # w x h of the world; drawing into a smaller framebuffer only
+        # shrinks it on screen.
+        self.scale = 1.0
 
     def update (self):
+        self.prevX = self.x
+        self.prevY = self.y
         self.getValues()
 
+    def interpolate (self, alpha):
+        # Place the view alpha of the way from the previous physics step
+        # to the latest one.
+        self.alpha = alpha
+        self.viewX = self.prevX + (self.x - self.prevX) * alpha
+        self.viewY = self.prevY + (self.y - self.prevY) * alpha
+
     def getValues (self):
-        mario = level.getMario()
+        mario = self.level.getMario()
         if mario is None:
             return
         if mario.x < screenSize[0]/2:
             self.x = 0
         else:
-            self.x = level.getMario().x - screenSize[0]/2 + tileWidth/2
+            self.x = mario.x - screenSize[0]/2 + tileWidth/2
+
+# Inputs
+# The game keys held for one frame, packed into a bitmask over gameKeys.
+# The keyboard is sampled into one of these once per frame and every state
+# reads that, and it is what input recordings store. It also stands in for
+# the keyboard when the game is driven directly, e.g. Inputs([K_d, K_SPACE])
+# for running right and jumping.
+class Inputs (object):
+    __slots__ = ("mask",)
+
+    def __init__ (self, pressed=(), mask=0):
+        for key in pressed:
+            mask |= gameKeyBits.get(key, 0)
+        self.mask = mask
+
+    def __getitem__ (self, key):
+        return (self.mask & gameKeyBits.get(key, 0)) != 0
+
+# InputRecorder
+# Writes the frame time and Inputs of every rendered frame to a file.
+# Fed back through InputReplay they make the game take exactly the same
+# physics steps with exactly the same keys. The header also notes which
+# level was played (levelDigest, from level_digest) and with which
+# options, as the same keys on another level play out differently.
+class InputRecorder (object):
+    def __init__ (self, fileHandle, physicsRate, maxSteps, levelDigest, enemyStore=False, stream=False):
+        flags = (inputEnemyStore if enemyStore else 0) | (inputStream if stream else 0)
+        self.f = open(fileHandle, "wb")
+        self.f.write(inputHeader.pack(inputMagic, inputVersion, physicsRate, maxSteps, flags, levelDigest))
+
+    def write (self, frameTime, inputs):
+        self.f.write(inputFrame.pack(frameTime, inputs.mask))
+
+    def close (self):
+        self.f.close()
+
+# InputReplay
+# Reads a file written by InputRecorder. frames holds (frameTime, Inputs)
+# for each recorded frame. physicsRate and maxSteps are what the game was
+# recorded with, and the replaying Game has to use the same; check()
+# makes sure it is also given the same level and options.
+class InputReplay (object):
+    def __init__ (self, fileHandle):
+        with open(fileHandle, "rb") as f:
+            data = f.read()
+        magic, version = inputMagicVersion.unpack_from(data, 0)
+        if magic != inputMagic or version != inputVersion:
+            raise ValueError("%s is not a version %d input recording" % (fileHandle, inputVersion))
+        magic, version, self.physicsRate, self.maxSteps, flags, self.levelDigest = inputHeader.unpack_from(data, 0)
+        self.enemyStore = bool(flags & inputEnemyStore)
+        self.stream = bool(flags & inputStream)
+        self.fileHandle = fileHandle
+        self.frames = []
+        for offset in range(inputHeader.size, len(data) - inputFrame.size + 1, inputFrame.size):
+            frameTime, mask = inputFrame.unpack_from(data, offset)
+            self.frames.append((frameTime, Inputs(mask=mask)))
+
+    def check (self, levelHandle, enemyStore, stream):
+        # Raises ValueError unless levelHandle and the options are the ones
+        # this was recorded with.
+        if level_digest(levelHandle) != self.levelDigest:
+            raise ValueError("%s was not recorded on %s" % (self.fileHandle, levelHandle))
+        if (enemyStore, stream) != (self.enemyStore, self.stream):
+            options = [name for name, on in (("--enemy-store", self.enemyStore), ("--stream", self.stream)) if on]
+            raise ValueError("%s was recorded with %s" % (self.fileHandle, " ".join(options) or "neither --enemy-store nor --stream"))
+
+# FrameProfiler
+# Times the phases of each frame (see profilerPhases) into ring buffers
+# holding the last capacity frames, so it costs the same however long the
+# game runs. Phase totals per frame feed the overlay; every timed span is
+# also kept for export as a Chrome trace (chrome://tracing or Perfetto).
+# "update" spans include the collision check inside them, but the per
+# frame totals count it under "collision" only.
+class FrameProfiler (object):
+    def __init__ (self, capacity=None):
+        if capacity is None:
+            capacity = profilerFrames
+        self.capacity = capacity
+        self.origin = timer()
+        self.frameStart = self.origin
+        self.frameCount = 0
+        self.current = dict((phase, 0.0) for phase in profilerPhases + ["frame"])
+        self.phaseTimes = dict((phase, [0.0] * capacity) for phase in profilerPhases)
+        self.frameTimes = [0.0] * capacity
+        spans = capacity * profilerSpansPerFrame
+        self.spanCount = 0
+        self.spanPhases = [None] * spans
+        self.spanStarts = [0.0] * spans
+        self.spanEnds = [0.0] * spans
+        self.font = None
+
+    def record (self, phase, start):
+        # Close a span of phase that began at start (a timer() reading).
+        end = timer()
+        self.current[phase] += end - start
+        i = self.spanCount % len(self.spanPhases)
+        self.spanPhases[i] = phase
+        self.spanStarts[i] = start
+        self.spanEnds[i] = end
+        self.spanCount += 1
+
+    def endFrame (self):
+        self.record("frame", self.frameStart)
+        i = self.frameCount % self.capacity
+        current = self.current
+        current["update"] -= current["collision"]
+        for phase in profilerPhases:
+            self.phaseTimes[phase][i] = current[phase]
+            current[phase] = 0.0
+        self.frameTimes[i] = current["frame"]
+        current["frame"] = 0.0
+        self.frameCount += 1
+        self.frameStart = timer()
+
+    def recent (self, times):
+        # The filled part of a ring buffer, oldest frame first.
+        count = self.frameCount
+        if count < self.capacity:
+            return times[:count]
+        i = count % self.capacity
+        return times[i:] + times[:i]
+
+    def percentiles (self, times, points=None):
+        # Milliseconds at each percentile in points (by default
+        # profilerPercentiles) over the recent frames.
+        if points is None:
+            points = profilerPercentiles
+        values = sorted(self.recent(times))
+        if not values:
+            return [0.0 for point in points]
+        return [1000.0 * values[int(point / 100.0 * (len(values) - 1))] for point in points]
+
+    def summary (self):
+        lines = ["%-9s %s" % ("ms", "  ".join("p%-5d" % point for point in profilerPercentiles))]
+        for phase in profilerPhases + ["frame"]:
+            times = self.frameTimes if phase == "frame" else self.phaseTimes[phase]
+            lines.append("%-9s %s" % (phase, "  ".join("%6.2f" % ms for ms in self.percentiles(times))))
+        return lines
+
+    def draw (self, screen):
+        # Stacked per-phase frame times for the recent frames, a line at
+        # the frame budget, and percentiles for each phase. The overlay is
+        # kept within screen, which is the framebuffer rather than the
+        # window when SDL scales the display.
+        if self.font is None:
+            self.font = pygame.font.Font(None, 18)
+        w = min(profilerOverlaySize[0], screen.get_width())
+        h = min(profilerOverlaySize[1], screen.get_height())
+        graphH = 100
+        overlay = pygame.Surface((w, h))
+        overlay.set_alpha(200)
+        overlay.fill(black)
+        scale = graphH / profilerGraphMs
+        frames = min(self.frameCount, w // 2)
+        columns = dict((phase, self.recent(self.phaseTimes[phase])[-frames:]) for phase in profilerPhases)
+        for i in range(frames):
+            bottom = graphH
+            for phase in profilerPhases:
+                barH = 1000.0 * columns[phase][i] * scale
+                if barH >= 1:
+                    pygame.draw.rect(overlay, profilerColors[phase], [w - 2 * (frames - i), bottom - barH, 2, barH])
+                bottom -= barH
+        budgetY = graphH - profilerBudgetMs * scale
+        pygame.draw.line(overlay, white, (0, budgetY), (w, budgetY))
+        for row, line in enumerate(self.summary()):
+            phase = line.split()[0]
+            color = profilerColors.get(phase, white)
+            overlay.blit(self.font.render(line, True, color), (4, graphH + 4 + 14 * row))
+        screen.blit(overlay, (0, 0))
+
+    def exportTrace (self, fileHandle):
+        # Write the recorded spans as complete ("X") events, timestamps in
+        # microseconds from when the profiler was made.
+        events = []
+        spans = len(self.spanPhases)
+        for n in range(max(self.spanCount - spans, 0), self.spanCount):
+            i = n % spans
+            start = self.spanStarts[i]
+            events.append({ "name":self.spanPhases[i], "cat":"frame", "ph":"X", "pid":0, "tid":0,
+                            "ts":(start - self.origin) * 1e6, "dur":(self.spanEnds[i] - start) * 1e6 })
+        with open(fileHandle, "w") as f:
+            json.dump({ "traceEvents":events, "displayTimeUnit":"ms" }, f)
+
+# RewindBuffer
+# The last capacity physics steps of a Game, for stepping back through
+# them one at a time. Each step is kept as an undo record: a partial
+# LevelSnapshot of what the step changed, taken by comparing against the
+# latest state (last). Only entities and tiles that were awake this step
+# or the one before can have changed, so that is all that gets compared.
+class RewindBuffer (object):
+    def __init__ (self, game, capacity=None):
+        if capacity is None:
+            capacity = rewindFrames
+        self.game = game
+        self.history = collections.deque(maxlen=capacity)
+        self.last = game.level.snapshot()
+        self.lastGame = game.snapshotValues()
+        self.lastAwake = list(game.level.awakeTiles)
+
+    def push (self):
+        # Record the step the game just took.
+        level = self.game.level
+        last = self.last
+        undo = LevelSnapshot(last.values, None, None, None, {})
+        last.values = level.snapshotValues()
+        if level.entities != last.entities:
+            undo.entities = last.entities
+            last.entities = list(level.entities)
+        if level.awakeTiles != last.awakeTiles:
+            undo.awakeTiles = last.awakeTiles
+            last.awakeTiles = list(level.awakeTiles)
+        if level.movingTiles != last.movingTiles:
+            undo.movingTiles = last.movingTiles
+            last.movingTiles = list(level.movingTiles)
+
+        # Entities removed this step may have changed on their way out.
+        states = last.states
+        for objects in (level.entities, undo.entities or (), level.awakeTiles, self.lastAwake):
+            for obj in objects:
+                values = capture_entity(obj)
+                old = states.get(obj)
+                if values != old:
+                    undo.states[obj] = old
+                    states[obj] = values
+        self.lastAwake = last.awakeTiles
+
+        game = self.game.snapshotValues()
+        self.history.append((self.lastGame, undo))
+        self.lastGame = game
+
+    def rewind (self):
+        # Undo the latest recorded step. Returns False once there is no
+        # history left.
+        if not self.history:
+            return False
+        game, undo = self.history.pop()
+        # Objects that didn't exist before the step (a spawned enemy) have
+        # nothing to go back to; dropping them from the entities is enough.
+        for obj in [obj for obj, values in undo.states.items() if values is None]:
+            del undo.states[obj]
+            del self.last.states[obj]
+        self.game.restoreValues(game)
+        self.game.level.restore(undo)
+
+        last = self.last
+        last.values = undo.values
+        if undo.entities is not None:
+            last.entities = list(undo.entities)
+        if undo.awakeTiles is not None:
+            last.awakeTiles = list(undo.awakeTiles)
+        if undo.movingTiles is not None:
+            last.movingTiles = list(undo.movingTiles)
+        last.states.update(undo.states)
+        self.lastAwake = last.awakeTiles
+        self.lastGame = game
+        return True
+
+# SpatialGrid
+# Buckets objects by the grid cells their rect overlaps so a query only
+# has to look at the few cells around a rect instead of the whole level.
+class SpatialGrid (object):
+    def __init__ (self, cellSize):
+        self.cellSize = cellSize
+        self.cells = {}
+        self.ranges = {}
+
+    def cellRange (self, rect):
+        size = self.cellSize
+        return (rect.left // size, rect.top // size,
+                (rect.right - 1) // size, (rect.bottom - 1) // size)
+
+    def insert (self, obj):
+        cellRange = self.cellRange(obj.rect)
+        self.ranges[obj] = cellRange
+        c0, r0, c1, r1 = cellRange
+        for row in range(r0, r1 + 1):
+            for col in range(c0, c1 + 1):
+                self.cells.setdefault((col, row), []).append(obj)
+
+    def remove (self, obj):
+        cellRange = self.ranges.pop(obj, None)
+        if cellRange is None:
+            return
+        c0, r0, c1, r1 = cellRange
+        for row in range(r0, r1 + 1):
+            for col in range(c0, c1 + 1):
+                cell = self.cells.get((col, row))
+                if cell is not None:
+                    cell.remove(obj)
+                    if not cell:
+                        del self.cells[(col, row)]
+
+    def move (self, obj):
+        # Only re-bucket when the object actually crossed a cell edge.
+        if self.ranges.get(obj) == self.cellRange(obj.rect):
+            return
+        self.remove(obj)
+        self.insert(obj)
+
+    def query (self, rect):
+        return self.queryArea(rect.left, rect.top, rect.right, rect.bottom)
+
+    def queryArea (self, left, top, right, bottom):
+        found = []
+        seen = set()
+        size = self.cellSize
+        c0, r0 = int(left // size), int(top // size)
+        c1, r1 = int((right - 1) // size), int((bottom - 1) // size)
+        for row in range(r0, r1 + 1):
+            for col in range(c0, c1 + 1):
+                cell = self.cells.get((col, row))
+                if cell is None:
+                    continue
+                for obj in cell:
+                    if obj not in seen:
+                        seen.add(obj)
+                        found.append(obj)
+        return found
+
+# ContactBuffer
+# Every contact in a level, kept in parallel lists that are allocated once
+# and reused. Slot i holds the object touched (others), the sides it was
+# touched on, the overlap depth, and in links the next slot of the same
+# object's contacts. An object only keeps the first and last slot of its
+# chain (contactHead, contactTail), and clearing its contacts hands the
+# whole chain back to the free list at once. The lists double when they
+# run out, so a busy level settles at its peak size.
+class ContactBuffer (object):
+    def __init__ (self, capacity=256):
+        self.others = []
+        self.sides = []
+        self.depths = []
+        self.links = []
+        self.free = -1
+        self.grow(capacity)
+
+    def grow (self, count):
+        start = len(self.others)
+        self.others.extend([None] * count)
+        self.sides.extend([0] * count)
+        self.depths.extend([0] * count)
+        self.links.extend(range(start + 1, start + count))
+        self.links.append(self.free)
+        self.free = start
+
+    def add (self, entity, other, sides, depth):
+        if self.free < 0:
+            self.grow(len(self.others))
+        i = self.free
+        self.free = self.links[i]
+        self.others[i] = other
+        self.sides[i] = sides
+        self.depths[i] = depth
+        self.links[i] = -1
+        if entity.contactHead < 0:
+            entity.contactHead = i
+        else:
+            self.links[entity.contactTail] = i
+        entity.contactTail = i
+
+    def clear (self, entity):
+        # The slots keep their old values until they are handed out again.
+        head = entity.contactHead
+        if head >= 0:
+            self.links[entity.contactTail] = self.free
+            self.free = head
+            entity.contactHead = -1
+            entity.contactTail = -1
+
+    def dispatch (self, entity, table):
+        # Hand entity's contacts, oldest first, to the handlers table
+        # holds for the kinds of entity and of the object touched (see
+        # State.contactHandlers). The walk stops at the first handler to
+        # return something true and returns that, leaving the contacts in
+        # place. It also stops once a handler clears the contacts, as the
+        # cleared slots are linked into the free list.
+        row = table[entity.contactKind]
+        others = self.others
+        sides = self.sides
+        links = self.links
+        i = entity.contactHead
+        while i >= 0:
+            other = others[i]
+            handler = row[other.contactKind]
+            if handler is not None:
+                result = handler(entity, other, sides[i])
+                if result or entity.contactHead < 0:
+                    return result
+            i = links[i]
+        return None
+
+    def saved (self, entity):
+        # entity's contacts as (other, sides, depth) tuples, for snapshots.
+        i = entity.contactHead
+        if i < 0:
+            return ()
+        found = []
+        while i >= 0:
+            found.append((self.others[i], self.sides[i], self.depths[i]))
+            i = self.links[i]
+        return tuple(found)
+
+# TileLayer
+# Pre-renders the static tiles into surfaces tileChunkColumns tiles wide so
+# a frame only blits the chunks the camera can see. A chunk is redrawn only
+# after one of its tiles reports a change through Level.tileChanged.
+class TileLayer (object):
+    def __init__ (self, level, chunkColumns):
+        self.level = level
+        self.chunkWidth = chunkColumns * tileWidth
+        self.chunks = {}
+        self.dirty = set()
+        self.scale = 1.0
+
+    def invalidate (self, tile):
+        for index in range(int(tile.x // self.chunkWidth), int((tile.x + tile.w - 1) // self.chunkWidth) + 1):
+            if index in self.chunks:
+                self.dirty.add(index)
+
+    def renderChunk (self, index, screen):
+        # Chunks are drawn at the layer's scale. Tile edges are scaled
+        # rather than tile sizes, so neighbouring tiles never leave a gap.
+        scale = self.scale
+        chunk = self.chunks.get(index)
+        if chunk is None:
+            chunk = pygame.Surface((int(math.ceil(self.chunkWidth * scale)), int(math.ceil(self.level.height * scale))), 0, screen)
+            self.chunks[index] = chunk
+        chunk.fill(screenBGColor)
+        left = index * self.chunkWidth
+        for tile in self.level.tileGrid.queryArea(left, 0, left + self.chunkWidth, self.level.height):
+            if tile.static:
+                x = int((tile.x - left) * scale)
+                y = int(tile.y * scale)
+                pygame.draw.rect(chunk, tile.color, [x, y, int((tile.x + tile.w - left) * scale) - x, int((tile.y + tile.h) * scale) - y], 0)
+        self.dirty.discard(index)
+        return chunk
+
+    def draw (self, screen, camera):
+        if camera.scale != self.scale:
+            self.scale = camera.scale
+            self.chunks = {}
+            self.dirty = set()
+        first = int(camera.viewX // self.chunkWidth)
+        last = int((camera.viewX + camera.w - 1) // self.chunkWidth)
+
+        # Only keep the chunks around the view; the rest are cheap to redo.
+        for index in list(self.chunks):
+            if index < first - 1 or index > last + 1:
+                del self.chunks[index]
+                self.dirty.discard(index)
+
+        for index in range(first, last + 1):
+            chunk = self.chunks.get(index)
+            if chunk is None or index in self.dirty:
+                chunk = self.renderChunk(index, screen)
+            screen.blit(chunk, ((index * self.chunkWidth - camera.viewX) * self.scale, -camera.viewY * self.scale))
+
+# RenderQueue
+# Collects the solid rects entities draw in a frame, in world coordinates,
+# and draws them all with one Surface.blits call: each is moved into view
+# space at the camera's scale, dropped if it is off screen and blitted
+# from a solid surface cached per color and size. Rects are drawn in the
+# order submitted, so overlaps come out as if each had been drawn on its
+# own.
+class RenderQueue (object):
+    def __init__ (self):
+        self.commands = []
+        self.surfaces = {}
+
+    def submit (self, color, x, y, w, h):
+        self.commands.append((color, x, y, w, h))
+
+    def flush (self, screen, camera):
+        left = camera.viewX
+        top = camera.viewY
+        right = left + camera.w
+        bottom = top + camera.h
+        scale = camera.scale
+        surfaces = self.surfaces
+        blits = []
+        for color, x, y, w, h in self.commands:
+            if x + w <= left or x >= right or y + h <= top or y >= bottom:
+                continue
+            w = int(w * scale)
+            h = int(h * scale)
+            key = (color[0], color[1], color[2], w, h)
+            surface = surfaces.get(key)
+            if surface is None:
+                surface = pygame.Surface((w, h), 0, screen)
+                surface.fill(color)
+                surfaces[key] = surface
+            blits.append((surface, ((x - left) * scale, (y - top) * scale)))
+        screen.blits(blits, False)
+        del self.commands[:]
+
+# EnemyStore
+# Optional array-backed storage for Goombas and Koopas, for crowded levels.
+# Each enemy's position, size, speed, direction and state sit in one row
+# of NumPy arrays and StoredGoomba/StoredKoopa objects are views of their
+# row. step() then patrols, drops and lands every enemy that is simply
+# walking or falling with a handful of array operations per physics step,
+# against a grid of which tile cells are solid. Enemies with contacts to
+# handle, or in any other state, still run through their State as usual.
+class EnemyStore (object):
+    floatFields = ("x", "y", "w", "h", "dx", "dy", "velocity", "prevX", "prevY")
+
+    def __init__ (self, columns, rows, capacity=64):
+        if numpy is None:
+            raise ImportError("the enemy store needs NumPy")
+        self.count = 0
+        self.entities = []
+        for name in self.floatFields:
+            setattr(self, name, numpy.zeros(capacity))
+        self.direction = numpy.zeros(capacity, numpy.int8)
+        self.state = numpy.zeros(capacity, numpy.int8)
+        self.moveStep = numpy.zeros(capacity, numpy.int64)
+        self.stepped = numpy.zeros(capacity, numpy.int64)
+        self.contact = numpy.zeros(capacity, bool)
+        self.solid = numpy.zeros((rows, columns), bool)
+
+    def allocate (self, entity):
+        # Hand out the next row. Rows are not reused, so a removed enemy
+        # still reads its last values through any reference left to it.
+        if self.count == len(self.state):
+            for name in self.floatFields + ("direction", "state", "moveStep", "stepped", "contact"):
+                array = getattr(self, name)
+                setattr(self, name, numpy.concatenate((array, numpy.zeros_like(array))))
+        row = self.count
+        self.count += 1
+        self.entities.append(entity)
+        self.dx[row] = enemySpeed
+        self.moveStep[row] = -1
+        self.stepped[row] = -1
+        return row
+
+    def release (self, entity):
+        # For good: a released row is never written or stepped again.
+        self.state[entity.row] = -1
+
+    def setSolid (self, tile, solid):
+        # Marks every cell the tile covers, as merged tiles span several.
+        row, col = max(int(tile.y // tileWidth), 0), max(int(tile.x // tileWidth), 0)
+        self.solid[row:int((tile.y + tile.h - 1) // tileWidth) + 1, col:int((tile.x + tile.w - 1) // tileWidth) + 1] = solid
+
+    def solidAt (self, cols, rows):
+        # Whether each (col, row) cell holds a tile. Outside the map is open.
+        rowCount, colCount = self.solid.shape
+        inside = (cols >= 0) & (cols < colCount) & (rows >= 0) & (rows < rowCount)
+        hit = numpy.zeros(len(cols), bool)
+        hit[inside] = self.solid[rows[inside], cols[inside]]
+        return hit
+
+    def step (self, level, deltaTime):
+        # Does for the batch what EnemyStateMove and EnemyStateFall do for
+        # one enemy. Walls and floors are taken from the solid grid, so
+        # tiles bumped out of place still count at their home cell.
+        count = self.count
+        if count == 0:
+            return
+        state = self.state[:count]
+        x, y, w, h = self.x[:count], self.y[:count], self.w[:count], self.h[:count]
+        dy, velocity = self.dy[:count], self.velocity[:count]
+        falling = state == enemyStateIds["fall"]
+
+        # Same closed form as fall_distance.
+        moveX = self.direction[:count] * self.dx[:count] * deltaTime
+        steps = deltaTime / physicsStep
+        terminal = falling & (dy > maxVelocity)
+        fall = numpy.where(terminal, maxVelocity * deltaTime,
+                           physicsStep * (dy * steps + velocity * steps * (steps + 1) / 2 + gravity * (steps + 1) * steps * (steps - 1) / 6))
+        fall = numpy.where(falling, fall, 0)
+        fallDy = numpy.where(terminal, maxVelocity, dy + velocity * steps + gravity * steps * (steps - 1) / 2)
+
+        # Only plain walkers and fallers moving less than a tile, so no
+        # step can skip past a wall or floor.
+        batch = (falling | (state == enemyStateIds["move"])) & ~self.contact[:count]
+        batch &= state >= 0
+        batch &= (numpy.abs(moveX) < tileWidth) & (fall < tileWidth)
+        area = level.activeArea()
+        if area is not None:
+            left, top, right, bottom = area
+            batch &= (x + w > left) & (x < right) & (y + h > top) & (y < bottom)
+        rows = numpy.nonzero(batch)[0]
+        if len(rows) == 0:
+            return
 
-# Struct
-class Struct (object):
-    def __init__ (self, **entries):
-        self.__dict__.update(entries)
+        x, y, w, h, moveX, fall = x[rows], y[rows], w[rows], h[rows], moveX[rows], fall[rows]
+        falling = falling[rows]
+        direction = self.direction[rows]
+        oldState = self.state[rows]
+
+        # Stop at the first wall column the leading edge reaches. Walkers
+        # turn around there, fallers just slide down it.
+        newX = x + moveX
+        forward = moveX > 0
+        edge = numpy.where(forward, numpy.ceil((x + w) / tileWidth), numpy.floor(x / tileWidth)) * tileWidth
+        crossed = numpy.where(forward, edge < newX + w, edge > newX)
+        wallCol = (edge / tileWidth - numpy.where(forward, 0, 1)).astype(int)
+        topRow = numpy.floor(y / tileWidth).astype(int)
+        bottomRow = (numpy.ceil((y + h) / tileWidth) - 1).astype(int)
+        wall = crossed & (self.solidAt(wallCol, topRow) | self.solidAt(wallCol, bottomRow))
+        newX = numpy.where(wall, numpy.where(forward, edge - w, edge), newX)
+        direction = numpy.where(wall & ~falling, -direction, direction)
+
+        # Land on the first floor row the bottom edge reaches.
+        floorY = numpy.ceil((y + h) / tileWidth) * tileWidth
+        floorRow = (floorY / tileWidth).astype(int)
+        leftCol = numpy.floor(newX / tileWidth).astype(int)
+        rightCol = (numpy.ceil((newX + w) / tileWidth) - 1).astype(int)
+        landed = falling & (fall > 0) & (floorY <= y + h + fall)
+        landed &= self.solidAt(leftCol, floorRow) | self.solidAt(rightCol, floorRow)
+        newY = numpy.where(landed, floorY - h, y + fall)
+
+        # Walkers with nothing under them start falling, as should_fall
+        # would find from their pixel rect.
+        left = numpy.trunc(newX).astype(int)
+        right = left + w.astype(int)
+        probeRow = (numpy.trunc(newY).astype(int) + h.astype(int)) // tileWidth
+        supported = self.solidAt((left + 1) // tileWidth, probeRow) | self.solidAt((right - 2) // tileWidth, probeRow)
+        drops = ~falling & ~supported
+        newState = numpy.where(landed, enemyStateIds["move"], numpy.where(drops, enemyStateIds["fall"], oldState))
+
+        stepCount = level.stepCount
+        fresh = rows[self.moveStep[rows] != stepCount]
+        self.prevX[fresh] = self.x[fresh]
+        self.prevY[fresh] = self.y[fresh]
+        self.moveStep[fresh] = stepCount
+        self.x[rows] = newX
+        self.y[rows] = newY
+        self.direction[rows] = direction
+        self.dy[rows] = numpy.where(falling, fallDy[rows], self.dy[rows])
+        self.velocity[rows] = numpy.where(drops, 0, numpy.where(falling, velocity[rows] + gravity * steps, velocity[rows]))
+        self.state[rows] = newState
+        self.stepped[rows] = stepCount
+
+        changed = newState != oldState
+        for row, old in zip(rows[changed], oldState[changed]):
+            entity = self.entities[row]
+            entity.prevState = entity.allStates.get(enemyStateNames[old])
+
+        # Rects stay plain attributes as the collision code reads them a
+        # lot, but only enemies that crossed a cell edge need re-bucketing.
+        entities = self.entities
+        for row, rectX, rectY, rectW, rectH in zip(rows.tolist(), newX.tolist(), newY.tolist(), w.tolist(), h.tolist()):
+            entities[row].rect = Rect(rectX, rectY, rectW, rectH)
+        size = level.entityGrid.cellSize
+        oldLeft, oldTop = numpy.trunc(x).astype(int), numpy.trunc(y).astype(int)
+        newTop = numpy.trunc(newY).astype(int)
+        width, height = w.astype(int), h.astype(int)
+        crossedCell = (oldLeft // size != left // size) | ((oldLeft + width - 1) // size != (right - 1) // size)
+        crossedCell |= (oldTop // size != newTop // size) | ((oldTop + height - 1) // size != (newTop + height - 1) // size)
+        for row in rows[crossedCell]:
+            if entities[row].grid is not None:
+                entities[row].grid.move(entities[row])
 
 # Entity
+# Entities keep everything about themselves in __slots__, state timers
+# included, so levels with many thousands of tiles stay small. States hold
+# no data of their own and one of each is shared by every entity.
 class Entity (object):
-    x = 0
-    y = 0
-    w = 0
-    h = 0
-    rect = Rect(x,y,w,h)
-    color = [0,0,0]
-    direction = "right"
-    currState = None
-    prevState = None
-        
+    __slots__ = ("x", "y", "w", "h", "rect", "color", "direction", "currState", "prevState", "allStates",
+                 "contactHead", "contactTail",
+                 "grid", "level", "loadOrder", "awake", "prevX", "prevY", "moveStep", "stateTime")
+
     def __init__ (self, x, y, w, h, color):
         self.x = x
         self.y = y
@@ -75,9 +758,20 @@ class Entity (object):
         self.h = h
         self.color = color
         self.rect = Rect(x,y,w,h)
-        self.allStates = {}
-        self.collidingObjects = []
-        self.hasCollision = False
+        self.direction = "right"
+        self.allStates = noStates
+        self.currState = None
+        self.prevState = None
+        self.contactHead = -1
+        self.contactTail = -1
+        self.grid = None
+        self.level = None
+        self.loadOrder = 0
+        self.awake = True
+        self.prevX = x
+        self.prevY = y
+        self.moveStep = -1
+        self.stateTime = 0
 
     def left (self):
         return self.x
@@ -88,53 +782,121 @@ class Entity (object):
     def top (self):
         return self.y
     def setY (self, y):
+        self.rememberPosition()
         self.y = y
-        self.rect = Rect(self.x, self.y, self.w, self.h)
+        self.updateRect()
     def setX (self, x):
+        self.rememberPosition()
         self.x = x
+        self.updateRect()
+    def updateRect (self):
         self.rect = Rect(self.x, self.y, self.w, self.h)
+        if self.grid is not None:
+            self.grid.move(self)
+
+    def rememberPosition (self):
+        # Keep where this object started the current physics step, so it
+        # can be drawn between its last two positions.
+        level = self.level
+        if level is not None and self.moveStep != level.stepCount:
+            self.moveStep = level.stepCount
+            self.prevX = self.x
+            self.prevY = self.y
+
+    def drawPosition (self, alpha):
+        if self.level is None or self.moveStep != self.level.stepCount:
+            return self.x, self.y
+        return self.prevX + (self.x - self.prevX) * alpha, self.prevY + (self.y - self.prevY) * alpha
 
     def translate (self, dx, dy):
+        self.rememberPosition()
         if dx < 0:
             self.direction = "left"
         elif dx > 0:
             self.direction = "right"
 
+        # Stop at whatever tile is in the way instead of moving into it.
+        if self.level is not None:
+            dx, dy = self.level.sweepMove(self, dx, dy)
+
         self.x += dx
 
         if isinstance(self, Mario) and self.x < 0:
             self.x = 0
         
         self.y += dy
-        self.rect = Rect(self.x,self.y,self.w,self.h)
+        self.updateRect()
 
     def changeState (self, stateID):
         if self.allStates.get(stateID) is None:
             return
         else:
-            self.newState = self.allStates.get(stateID)
+            newState = self.allStates.get(stateID)
             self.currState.exitState(self)
             self.prevState = self.currState
-            self.currState = self.newState
-            self.currState.enterState(self)
+            self.currState = newState
+            newState.enterState(self)
+            self.wake()
+
+    def addCollision (self, collided, sides, depth):
+        self.level.contacts.add(self, collided, sides, depth)
+        self.wake()
+
+    def wake (self):
+        if not self.awake:
+            self.awake = True
+            if self.level is not None:
+                self.level.wake(self)
+
+    def canSleep (self):
+        # Asleep objects are skipped by Level.update until a contact or
+        # state change wakes them again.
+        return self.currState.sleeps and self.contactHead < 0
 
-    def addCollision (self, collided):
-        self.collidingObjects.append(collided)
-        self.hasCollision = True
+    def handleContacts (self, table):
+        # See ContactBuffer.dispatch.
+        return self.level.contacts.dispatch(self, table)
 
-    def draw (self):
-        pygame.draw.rect(screen, self.color, [self.x - camera.x, self.y - camera.y, self.w, self.h], 0)
+    def clearCollisions (self):
+        if self.contactHead >= 0:
+            self.level.contacts.clear(self)
+
+    def isActive (self):
+        return True
+
+    def draw (self, queue, alpha):
+        x, y = self.drawPosition(alpha)
+        queue.submit(self.color, x, y, self.w, self.h)
 
 # Enemy
 class Enemy (Entity):
+    __slots__ = ("spawnX", "isSpawned", "isDead", "isDeadDead", "velocity", "dy")
+
+    def __init__ (self, x, y, w, h, color):
+        Entity.__init__(self, x, y, w, h, color)
+
+    def isActive (self):
+        # Enemies tumbling off screen no longer touch anything.
+        return self.isSpawned and not self.isDeadDead and not isinstance(self.currState, EnemyStateKnocked)
+
+# Tile
+class Tile (Entity):
+    # Static tiles are drawn from the level's TileLayer instead of
+    # every frame. Tiles start asleep.
+    __slots__ = ("static",)
+
     def __init__ (self, x, y, w, h, color):
         Entity.__init__(self, x, y, w, h, color)
+        self.static = True
+        self.awake = False
 
 # Coin
 class Coin (Entity):
+    __slots__ = ("active",)
+
     def __init__ (self, x, y, w, h, color):
         Entity.__init__(self, x, y, w, h, color)
-        self.allStates = { "idle":CoinStateIdle(), "unused":CoinStateUnused() }
+        self.allStates = coinStates
         self.prevState = self.allStates.get("idle")
         self.currState = self.prevState
         self.active = False
@@ -143,26 +905,38 @@ class Coin (Entity):
         if self.active:
             self.currState.execute(self, deltaTime)
 
-    def draw (self):
+    def isActive (self):
+        return self.active
+
+    def canSleep (self):
+        return not self.active and self.contactHead < 0
+
+    def draw (self, queue, alpha):
         if self.active:
-            Entity.draw(self)    
+            Entity.draw(self, queue, alpha)    
 
 # BrickBlock
-class BrickBlock (Entity):
+class BrickBlock (Tile):
+    __slots__ = ("startY", "bumpStep")
+
     def __init__ (self, x, y, w, h, color):
-        Entity.__init__(self, x, y, w, h, color)
-        self.allStates = { "idle":BrickBlockStateIdle(), "hitLight":BrickBlockStateHitLight() }#, "hit_hard":BrickBlockStateHitHard() }   
+        Tile.__init__(self, x, y, w, h, color)
+        self.allStates = brickBlockStates
         self.prevState = self.allStates.get("idle")
         self.currState = self.prevState
+        self.startY = y
+        self.bumpStep = 0
         
     def update (self, deltaTime):
         self.currState.execute(self, deltaTime)
 
 # QuestionBlock
-class QuestionBlock (Entity):
+class QuestionBlock (Tile):
+    __slots__ = ("contents", "used")
+
     def __init__ (self, x, y, w, h, contents, color):
-        Entity.__init__(self, x, y, w, h, color)
-        self.allStates = { "idle":QuestionBlockStateIdle(), "hit":QuestionBlockStateHit() }
+        Tile.__init__(self, x, y, w, h, color)
+        self.allStates = questionBlockStates
         self.prevState = self.allStates.get("idle")
         self.currState = self.prevState
         self.contents = contents
@@ -172,10 +946,12 @@ class QuestionBlock (Entity):
         self.currState.execute(self, deltaTime)
 
 # GroundBlock 
-class GroundBlock (Entity):
+class GroundBlock (Tile):
+    __slots__ = ()
+
     def __init__ (self, x, y, w, h, color):
-        Entity.__init__(self, x, y, w, h, color)
-        self.allStates = { "idle":GroundBlockStateIdle() }
+        Tile.__init__(self, x, y, w, h, color)
+        self.allStates = groundBlockStates
         self.prevState = self.allStates.get("idle")
         self.currState = self.prevState
 
@@ -184,28 +960,39 @@ class GroundBlock (Entity):
 
 # Mushroom
 class Mushroom (Entity):
+    __slots__ = ("active", "dy", "velocity", "startY")
+
     def __init__ (self, x, y, w, h, color):
         Entity.__init__(self, x, y, w, h, color)
-        self.allStates = { "spawn":MushroomStateSpawn(), "move":MushroomStateMove(), "fall":MushroomStateFall() }
+        self.allStates = mushroomStates
         self.prevState = self.allStates.get("spawn")
         self.currState = self.prevState
         self.active = False
         self.dy = 0
         self.velocity = 0
+        self.startY = y
 
     def update (self, deltaTime):
         if self.active:
             self.currState.execute(self, deltaTime)
 
-    def draw (self):
+    def isActive (self):
+        return self.active
+
+    def canSleep (self):
+        return not self.active and self.contactHead < 0
+
+    def draw (self, queue, alpha):
         if self.active:
-            Entity.draw(self)
+            Entity.draw(self, queue, alpha)
 
 # Goomba
 class Goomba (Enemy):
+    __slots__ = ()
+
     def __init__ (self, x, y, w, h, spawnX, color):
         Enemy.__init__(self, x, y, w, h, color)
-        self.allStates = { "wait":EnemyStateWait(), "move":EnemyStateMove(), "fall":EnemyStateFall(), "stomped":GoombaStateStomped() }
+        self.allStates = goombaStates
         self.prevState = self.allStates.get("wait")
         self.currState = self.prevState
         self.spawnX = spawnX
@@ -220,15 +1007,17 @@ class Goomba (Enemy):
         if not self.isDeadDead:
             self.currState.execute(self, deltaTime)
 
-    def draw (self):
+    def draw (self, queue, alpha):
         if self.isSpawned and not self.isDeadDead:
-            Entity.draw(self)
+            Entity.draw(self, queue, alpha)
 
 # Koopa
 class Koopa (Enemy):
+    __slots__ = ("inShell",)
+
     def __init__ (self, x, y, w, h, spawnX, color):
         Enemy.__init__(self, x, y, w, h, color)
-        self.allStates = { "wait":EnemyStateWait(), "move":EnemyStateMove(), "fall":EnemyStateFall(), "stomped":KoopaStateStomped(), "shellMove":KoopaStateShellMove() }
+        self.allStates = koopaStates
         self.prevState = self.allStates.get("wait")
         self.currState = self.prevState
         self.spawnX = spawnX
@@ -244,15 +1033,89 @@ class Koopa (Enemy):
         if not self.isDeadDead:
             self.currState.execute(self, deltaTime)
 
-    def draw (self):
+    def draw (self, queue, alpha):
         if self.isSpawned and not self.isDeadDead:
-            Entity.draw(self)
+            Entity.draw(self, queue, alpha)
+
+# EnemyView
+# Mixed in ahead of an enemy class to keep its fields in a row of an
+# EnemyStore instead of on the object. Rows stepped by EnemyStore.step
+# skip their State for that physics step.
+def stored_field (name):
+    def get (self):
+        return getattr(self.store, name)[self.row]
+    def set (self, value):
+        getattr(self.store, name)[self.row] = value
+    return property(get, set)
+
+class EnemyView (object):
+    __slots__ = ()
+
+    x = stored_field("x")
+    y = stored_field("y")
+    w = stored_field("w")
+    h = stored_field("h")
+    dy = stored_field("dy")
+    velocity = stored_field("velocity")
+    prevX = stored_field("prevX")
+    prevY = stored_field("prevY")
+    moveStep = stored_field("moveStep")
+
+    def __init__ (self, store, *args):
+        self.store = store
+        self.row = store.allocate(self)
+        super(EnemyView, self).__init__(*args)
+
+    @property
+    def direction (self):
+        return "left" if self.store.direction[self.row] < 0 else "right"
+    @direction.setter
+    def direction (self, value):
+        self.store.direction[self.row] = -1 if value == "left" else 1
+
+    @property
+    def currState (self):
+        stateId = self.store.state[self.row]
+        if stateId < 0:
+            return None
+        return self.allStates.get(enemyStateNames[stateId])
+    @currState.setter
+    def currState (self, value):
+        # A removed enemy leaves as it was; changeState sets its next
+        # state only after exitState has released the row.
+        if self.store.state[self.row] < 0:
+            return
+        for name, state in self.allStates.items():
+            if state is value:
+                self.store.state[self.row] = enemyStateIds[name]
+
+    def addCollision (self, collided, sides, depth):
+        super(EnemyView, self).addCollision(collided, sides, depth)
+        self.store.contact[self.row] = True
+
+    def clearCollisions (self):
+        super(EnemyView, self).clearCollisions()
+        self.store.contact[self.row] = False
+
+    def update (self, deltaTime):
+        if self.store.stepped[self.row] != self.level.stepCount:
+            super(EnemyView, self).update(deltaTime)
+
+# StoredGoomba
+class StoredGoomba (EnemyView, Goomba):
+    __slots__ = ("store", "row")
+
+# StoredKoopa
+class StoredKoopa (EnemyView, Koopa):
+    __slots__ = ("store", "row")
 
 # Pipe
-class Pipe (Entity):
+class Pipe (Tile):
+    __slots__ = ()
+
     def __init__ (self, x, y, w, h, color):
-        Entity.__init__(self, x, y, w, h, color)
-        self.allStates = { "idle":PipeStateIdle() }
+        Tile.__init__(self, x, y, w, h, color)
+        self.allStates = pipeStates
         self.prevState = self.allStates.get("idle")
         self.currState = self.prevState
 
@@ -261,15 +1124,19 @@ class Pipe (Entity):
 
 # Mario
 class Mario (Entity):
+    __slots__ = ("speed", "isDead", "dy", "velocity", "dx", "run")
+
     def __init__ (self, x, y, w, h, color):
         Entity.__init__(self, x, y, w, h, color)
-        self.allStates = { "idle":MarioStateIdle(), "move":MarioStateMove(), "jump":MarioStateJump(), "fall":MarioStateFall() }
+        self.allStates = marioStates
         self.prevState = self.allStates.get("idle")
         self.currState = self.prevState
         self.speed = 0.5
         self.isDead = False
         self.dy = 0
         self.velocity = 0
+        self.dx = 0
+        self.run = False
         
     def update (self, deltaTime):
         self.currState.execute(self, deltaTime)
@@ -277,6 +1144,35 @@ class Mario (Entity):
 
 # State
 class State (object):
+    # Whether an object in this state can sleep once it has no contacts
+    # left to handle.
+    sleeps = False
+
+    # What an object in this state does about each of its contacts: the
+    # name of a handler method for each (kind of this object, kind of the
+    # object touched) from contactKinds, with None standing for any kind.
+    # A handler takes (entity, other, sides) and returns something true to
+    # stop handling the rest.
+    contactHandlers = {}
+
+    def __init__ (self):
+        self.contactTable = self.buildContactTable(self.contactHandlers)
+
+    def buildContactTable (self, handlers):
+        # A row for each kind of this object, with the handler bound for
+        # each kind touched, so dispatching a contact is two list lookups.
+        table = []
+        for kind in contactKinds:
+            row = []
+            for other in contactKinds:
+                name = None
+                for key in ((kind, other), (kind, None), (None, other), (None, None)):
+                    if key in handlers:
+                        name = handlers[key]
+                        break
+                row.append(getattr(self, name) if name is not None else None)
+            table.append(row)
+        return table
 
     def enterState (self, entity):
         raise NotImplementedError("Please Implement enter() in State subclass.")
@@ -289,11 +1185,17 @@ class State (object):
 
 # MarioStateIdle
 class MarioStateIdle (State):
+    def hitEnemy (self, entity, enemy, sides):
+        if not enemy.isDead and sides & (sideLeft | sideRight | sideTop):
+            entity.isDead = True
+
+    contactHandlers = { (Mario, Enemy):"hitEnemy" }
+
     def enterState (self, entity):
         return
 
     def execute (self, entity, deltaTime):
-        key = pygame.key.get_pressed()
+        key = entity.level.inputs
         if key[K_SPACE]:
             entity.changeState("jump")
         elif key[K_a]:
@@ -302,26 +1204,38 @@ class MarioStateIdle (State):
         elif key[K_d]:
             entity.direction = "right"
             entity.changeState("move")
+        elif key[K_s]:
+            pipe = tile_below(entity)
+            if isinstance(pipe, Pipe):
+                entity.level.leaveByPipe(pipe)
 
-        if entity.hasCollision:
-            for tile in entity.collidingObjects:
-                sides = collision_sides(entity.rect, tile.rect)
-                if isinstance(tile, Enemy) and not tile.isDead and (sides.left or sides.right or sides.top):
-                    entity.isDead = True
-            entity.hasCollision = False
-            entity.collidingObjects = []
+        entity.handleContacts(self.contactTable)
+        entity.clearCollisions()
 
     def exitState (self, entity):
-        entity.hasCollision = False
-        entity.collidingObjects = []
+        entity.clearCollisions()
 
 # MarioStateMove
 class MarioStateMove (State):
+    def hitEnemy (self, entity, enemy, sides):
+        # If an enemy and still alive then hurt mario.
+        if sides & (sideLeft | sideRight | sideTop) and not enemy.isDead:
+            entity.isDead = True
+        self.pushBack(entity, enemy, sides)
+
+    def pushBack (self, entity, tile, sides):
+        if sides & sideLeft:
+            entity.setX(tile.x + tile.w)
+        elif sides & sideRight:
+            entity.setX(tile.x - entity.w)
+
+    contactHandlers = { (Mario, Enemy):"hitEnemy", (Mario, None):"pushBack" }
+
     def enterState (self, entity):
-        self.run = False
+        entity.run = False
     
     def execute (self, entity, deltaTime):
-        key = pygame.key.get_pressed()
+        key = entity.level.inputs
 
         # Check for move off of any platform
         shouldFall = should_fall(entity)
@@ -333,171 +1247,218 @@ class MarioStateMove (State):
             entity.changeState("jump")
         
         if key[K_LSHIFT]:
-            self.run = True
+            entity.run = True
             
         if key[K_a]:
-            if self.run:
+            if entity.run:
                 entity.translate(-(entity.speed) * 2 * deltaTime, 0)
             else:
                 entity.translate(-(entity.speed) * deltaTime, 0)
             entity.direction = "left"
             
         if key[K_d]:
-            if self.run:
+            if entity.run:
                 entity.translate(entity.speed * 2 * deltaTime, 0)
             else:
                 entity.translate(entity.speed * deltaTime, 0)
             entity.direction = "right"
 
         if not key[K_LSHIFT]:
-            self.run = False
+            entity.run = False
 
         if not key[K_a] and not key[K_d]:
             entity.changeState("idle")
 
         # Check for move into something.
-        if entity.hasCollision:
-            for tile in entity.collidingObjects:
-                sides = collision_sides(entity.rect, tile.rect)
-                if isinstance(tile, Enemy) and (sides.left or sides.right or sides.top):
-                    # If an enemy and still alive then hurt mario.
-                    if not tile.isDead:
-                        entity.isDead = True
-                if sides.left:
-                    entity.setX(tile.x + tile.w)
-                elif sides.right:
-                    entity.setX(tile.x - entity.w)
-            entity.hasCollision = False
-            entity.collidingObjects = []
+        entity.handleContacts(self.contactTable)
+        entity.clearCollisions()
  
     def exitState (self, entity):
-        entity.hasCollision = False
-        entity.collidingObjects = []
+        entity.clearCollisions()
 
-# MarioStateJump
-class MarioStateJump (State):
-    def enterState (self, entity):
-        entity.dy = 0
-        entity.velocity = -0.2
-        self.startHeight = entity.y
-        self.dx = 0
+# MarioStateFall
+class MarioStateFall (State):
+    def landOn (self, entity, tile, sides):
+        if sides & sideBottom:
+            entity.setY(tile.top() - entity.h)
+            entity.changeState("idle")
+            return True
+
+    def landOnEnemy (self, entity, enemy, sides):
+        # Bounce off an enemy that is still alive.
+        if sides & sideBottom and not enemy.isDead:
+            entity.dy = 0
+            entity.velocity = -0.15
+            return
+        return self.landOn(entity, enemy, sides)
+
+    contactHandlers = { (Mario, Enemy):"landOnEnemy", (Mario, None):"landOn" }
 
+    def enterState (self, entity):
+        entity.dx = 0
+        entity.velocity = 0
+    
     def execute (self, entity, deltaTime):
         # Check in-air movement.
-        key = pygame.key.get_pressed()
+        key = entity.level.inputs
         speed = entity.speed
-        jumpGravity = gravity
 
         if key[K_LSHIFT]:
             speed *= 2
-            jumpGravity *= 0.9
         if key[K_a]:
             entity.direction = "left"
-            self.dx = -speed
+            entity.dx = -speed
         if key[K_d]:
             entity.direction = "right"
-            self.dx = speed
+            entity.dx = speed
 
-        # Check collisions.
-        if entity.hasCollision:
-            for tile in entity.collidingObjects:
-                sides = collision_sides(entity.rect, tile.rect)
-                if sides.top:
-                    entity.setY(tile.bottom() + (entity.y - tile.y))
-                    entity.velocity = 0
-                    entity.dy = 0
-                if sides.bottom:
-                    if isinstance(tile, Enemy) and not tile.isDead:
-                        entity.dy = 0
-                        entity.velocity = -0.15
-                    else:
-                        entity.setY(tile.top() - entity.h)
-                        entity.changeState("idle")
-                        return
-
-        # Don't go so fast that collisions are missed
-        if entity.dy > maxVelocity:
-            entity.dy = maxVelocity
-        else:
-            entity.dy += entity.velocity
+        # Check for landing
+        if entity.handleContacts(self.contactTable):
+            return
+        entity.clearCollisions()
         
-        entity.velocity += jumpGravity
-        entity.translate(self.dx * deltaTime, entity.dy * deltaTime)
+        entity.translate(entity.dx * deltaTime, fall_distance(entity, deltaTime, gravity))
 
     def exitState (self, entity):
-        entity.hasCollision = False
-        entity.collidingObjects = []
-    
+        entity.clearCollisions()
+
+# MarioStateJump
+# Falls the same way once a jump comes down, after rising and bumping into
+# whatever is overhead on the way up.
+class MarioStateJump (MarioStateFall):
+    def bumpHead (self, entity, tile, sides):
+        if sides & sideTop:
+            entity.setY(tile.bottom())
+            entity.velocity = 0
+            entity.dy = 0
+
+    def bumpInto (self, entity, tile, sides):
+        self.bumpHead(entity, tile, sides)
+        return self.landOn(entity, tile, sides)
+
+    def bumpIntoEnemy (self, entity, enemy, sides):
+        self.bumpHead(entity, enemy, sides)
+        return self.landOnEnemy(entity, enemy, sides)
+
+    contactHandlers = { (Mario, Enemy):"bumpIntoEnemy", (Mario, None):"bumpInto" }
 
-# MarioStateFall
-class MarioStateFall (State):
     def enterState (self, entity):
-        self.dx = 0
-        entity.velocity = 0
-    
+        entity.dy = 0
+        entity.velocity = -0.2
+        entity.dx = 0
+
     def execute (self, entity, deltaTime):
         # Check in-air movement.
-        key = pygame.key.get_pressed()
+        key = entity.level.inputs
         speed = entity.speed
+        jumpGravity = gravity
 
         if key[K_LSHIFT]:
             speed *= 2
+            jumpGravity *= 0.9
         if key[K_a]:
             entity.direction = "left"
-            self.dx = -speed
+            entity.dx = -speed
         if key[K_d]:
             entity.direction = "right"
-            self.dx = speed
+            entity.dx = speed
 
-        # Check for landing
-        if entity.hasCollision:
-            for tile in entity.collidingObjects:
-                sides = collision_sides(entity.rect, tile.rect)
-                if sides.bottom:
-                    if isinstance(tile, Enemy) and not tile.isDead:
-                        entity.dy = 0
-                        entity.velocity = -0.15
-                    else:
-                        entity.setY(tile.top() - entity.h)
-                        entity.changeState("idle")
-                        return
-        
-        if entity.dy > maxVelocity:
-            entity.dy = maxVelocity
-        else:
-            entity.dy += entity.velocity
-            
-        entity.velocity += gravity
-        entity.translate(self.dx * deltaTime, entity.dy * deltaTime)
+        # Check collisions.
+        if entity.handleContacts(self.contactTable):
+            return
+        entity.clearCollisions()
+
+        entity.translate(entity.dx * deltaTime, fall_distance(entity, deltaTime, jumpGravity))
 
     def exitState (self, entity):
-        entity.hasCollision = False
-        entity.collidingObjects = []
+        entity.clearCollisions()
 
 # EnemyStateWait
+# The state enemies are built in. Level.spawnEnemies only builds them
+# once Mario is near and moves them straight on to "move", so all that is
+# left of waiting is marking them spawned on the way out.
 class EnemyStateWait (State):
     def enterState (self, entity):
         return
 
     def execute (self, entity, deltaTime):
-        # Wait until player reaches some X position on the
-        # level before updating and drawing this enemy instance.
-        if level.getMario().x > entity.spawnX:
-            entity.changeState("move")
+        return
 
     def exitState(self, entity):
         entity.isSpawned = True
 
+# WalkState
+# Shared by the states of things that walk along and turn around when they
+# run into something.
+class WalkState (State):
+    def turnAround (self, entity, tile, sides):
+        if sides & sideLeft:
+            entity.setX(tile.x + tile.w)
+            entity.direction = "right"
+        elif sides & sideRight:
+            entity.setX(tile.x - entity.w)
+            entity.direction = "left"
+
+    contactHandlers = { (None, None):"turnAround" }
+
+# FallState
+# Shared by the states of things that fall until they land on something.
+class FallState (State):
+    def landOn (self, entity, tile, sides):
+        if sides & sideBottom:
+            entity.setY(tile.top() - entity.h)
+            entity.changeState("idle")
+            entity.clearCollisions()
+            return True
+
+    def landOnMario (self, entity, mario, sides):
+        # If entity fell on Mario then it's an enemy
+        # and this should trigger death or power-down in Mario.
+        if sides & sideBottom:
+            return mario
+
+    landingHandlers = { (None, Mario):"landOnMario", (None, None):"landOn" }
+
+    def __init__ (self):
+        State.__init__(self)
+        self.landingTable = self.buildContactTable(self.landingHandlers)
+
+    def updateFall (self, entity, deltaTime):
+        # Check for landing. Coming down on Mario stops the fall without
+        # landing.
+        stop = entity.handleContacts(self.landingTable)
+        if stop:
+            return stop is True
+        entity.clearCollisions()
+
+        entity.translate(0, fall_distance(entity, deltaTime, gravity))
+        return False
+
 # EnemyStateMove
-class EnemyStateMove (State):
+class EnemyStateMove (WalkState):
+    def hitEnemy (self, entity, enemy, sides):
+        # That something was a kicked shell.
+        if is_moving_shell(enemy):
+            entity.changeState("knocked")
+            return True
+        self.turnAround(entity, enemy, sides)
+
+    def hitMario (self, entity, mario, sides):
+        # That something was Mario.
+        if sides & sideTop:
+            entity.changeState("stomped")
+        self.turnAround(entity, mario, sides)
+
+    contactHandlers = { (Enemy, Enemy):"hitEnemy", (Enemy, Mario):"hitMario", (Enemy, None):"turnAround" }
+
     def enterState (self, entity):
         return
 
     def execute (self, entity, deltaTime):
         if entity.direction == "left":
-            entity.translate(-(0.1 * deltaTime), 0)
+            entity.translate(-(enemySpeed * deltaTime), 0)
         else:
-            entity.translate(0.1 * deltaTime, 0)
+            entity.translate(enemySpeed * deltaTime, 0)
 
         # Check if should fall.
         shouldFall = should_fall(entity)
@@ -505,41 +1466,38 @@ class EnemyStateMove (State):
             entity.changeState("fall")
 
         # Check for move into something.
-        if entity.hasCollision:
-            for tile in entity.collidingObjects:
-                sides = collision_sides(entity.rect, tile.rect)
-                
-                # That something was Mario.
-                if sides.top and isinstance(tile, Mario):
-                    entity.changeState("stomped")
-                    
-                if sides.left:
-                    entity.setX(tile.x + tile.w)
-                    entity.direction = "right"
-                elif sides.right:
-                    entity.setX(tile.x - entity.w)
-                    entity.direction = "left"
-                
-            entity.hasCollision = False
-            entity.collidingObjects = []
+        if entity.handleContacts(self.contactTable):
+            return
+        entity.clearCollisions()
 
     def exitState(self, entity):
         return
 
 # EnemyStateFall
-class EnemyStateFall (State):
+class EnemyStateFall (FallState):
+    def hitEnemy (self, entity, enemy, sides):
+        # Knocked out of the air by a kicked shell.
+        if is_moving_shell(enemy):
+            entity.changeState("knocked")
+            return True
+
+    contactHandlers = { (Enemy, Enemy):"hitEnemy" }
+
     def enterState (self, entity):
         entity.velocity = 0
 
     def execute (self, entity, deltaTime):
+        if entity.handleContacts(self.contactTable):
+            return
+
         # Update X
         if entity.direction == "left":
-            entity.translate(-(0.1 * deltaTime), 0)
+            entity.translate(-(enemySpeed * deltaTime), 0)
         else:
-            entity.translate(0.1 * deltaTime, 0)
+            entity.translate(enemySpeed * deltaTime, 0)
 
         # Update Y
-        landed = updateFall(entity, deltaTime)
+        landed = self.updateFall(entity, deltaTime)
 
         # Check land
         if landed:
@@ -550,72 +1508,97 @@ class EnemyStateFall (State):
 
 # GoombaStateStomped
 class GoombaStateStomped (State):
+    squishTime = 1000 # one second
+
     def enterState (self, entity):
-        self.time = 0
-        self.squishTime = 1000 # one second
+        entity.stateTime = 0
         entity.y += entity.h/2
         entity.h /= 2
-        entity.rect = Rect(entity.x, entity.y, entity.w, entity.h)
+        entity.updateRect()
         entity.isDead = True
 
     def execute (self, entity, deltaTime):
-        self.time += deltaTime
+        entity.stateTime += deltaTime
+        # Squashed, it no longer reacts to anything.
+        entity.clearCollisions()
 
         # When time is up, switch to any state to remove goomba for good.
-        if self.time > self.squishTime:
+        if entity.stateTime > self.squishTime:
             entity.changeState("move")
 
     def exitState(self, entity):
         entity.isDeadDead = True
-        level.removeEntity(entity)
+        entity.level.removeEntity(entity)
 
 # KoopaStateStomped
 class KoopaStateStomped (State):
+    recoverTime = 5000 # five seconds
+
+    def hitEnemy (self, entity, enemy, sides):
+        # Another shell knocks this one away.
+        if is_moving_shell(enemy):
+            entity.changeState("knocked")
+            return True
+
+    def kickedBy (self, entity, mario, sides):
+        # Decide which way to shoot shell.
+        if mario.x <= entity.x:
+            entity.direction = "right"
+        else:
+            entity.direction = "left"
+        # Shoot shell.
+        entity.isDead = False
+        entity.changeState("shellMove")
+
+    contactHandlers = { (Enemy, Enemy):"hitEnemy", (Enemy, Mario):"kickedBy" }
+
     def enterState (self, entity):
-        self.time = 0
-        self.recoverTime = 5000 # five seconds
+        entity.stateTime = 0
         if entity.inShell == False:
             entity.y += entity.h/2
             entity.h /= 2
-            entity.rect = Rect(entity.x, entity.y, entity.w, entity.h)
+            entity.updateRect()
         entity.inShell = True
         entity.isDead = True
 
     def execute (self, entity, deltaTime):
-        self.time += deltaTime
+        entity.stateTime += deltaTime
 
         # Come back out of shell.
-        if self.time > self.recoverTime:
+        if entity.stateTime > self.recoverTime:
             entity.isDead = False
             entity.inShell = False
             entity.changeState("move")
             entity.y -= entity.h*2
             entity.h *= 2
-            entity.rect = Rect(entity.x, entity.y, entity.w, entity.h)
+            entity.updateRect()
             return
 
         # Otherwise check for mario hitting it in some direction.
-        if entity.hasCollision:
-            for tile in entity.collidingObjects:
-                sides = collision_sides(entity.rect, tile.rect)
-                if isinstance(tile, Mario):
-                    # Decide which way to shoot shell.
-                    if tile.x <= entity.x:
-                        entity.direction = "right"
-                    else:
-                        entity.direction = "left"
-                    # Shoot shell.
-                    entity.isDead = False
-                    entity.changeState("shellMove")
-
-            entity.hasCollision = False
-            entity.collidingObjects = []
+        if entity.handleContacts(self.contactTable):
+            return
+        entity.clearCollisions()
 
     def exitState (self, entity):
         return
 
 # KoopaStateShellMove
-class KoopaStateShellMove (State):
+class KoopaStateShellMove (WalkState):
+    def hitEnemy (self, entity, enemy, sides):
+        # Shells plough through other enemies, which knock
+        # themselves out. Two shells take each other out.
+        if is_moving_shell(enemy):
+            entity.changeState("knocked")
+            return True
+
+    def hitMario (self, entity, mario, sides):
+        # That something was Mario.
+        if sides & sideTop:
+            entity.changeState("stomped")
+        self.turnAround(entity, mario, sides)
+
+    contactHandlers = { (Enemy, Enemy):"hitEnemy", (Enemy, Mario):"hitMario", (Enemy, None):"turnAround" }
+
     def enterState (self, entity):
         return
 
@@ -631,142 +1614,162 @@ class KoopaStateShellMove (State):
             entity.changeState("fall")
 
         # Check for move into something.
-        if entity.hasCollision:
-            for tile in entity.collidingObjects:
-                sides = collision_sides(entity.rect, tile.rect)
-                
-                # That something was Mario.
-                if sides.top and isinstance(tile, Mario):
-                    entity.changeState("stomped")
-                
-                if sides.left:
-                    entity.setX(tile.x + tile.w)
-                    entity.direction = "right"
-                elif sides.right:
-                    entity.setX(tile.x - entity.w)
-                    entity.direction = "left"
-                
-            entity.hasCollision = False
-            entity.collidingObjects = []
+        if entity.handleContacts(self.contactTable):
+            return
+        entity.clearCollisions()
+
+    def exitState(self, entity):
+        return
+
+# EnemyStateKnocked
+class EnemyStateKnocked (State):
+    def enterState (self, entity):
+        entity.isDead = True
+        entity.dy = -0.4
+        entity.velocity = 0
+        entity.clearCollisions()
+
+    def execute (self, entity, deltaTime):
+        # Pop up and fall straight through the world.
+        entity.setY(entity.y + fall_distance(entity, deltaTime, gravity))
+
+        if entity.y > screenSize[1]:
+            entity.isDeadDead = True
+            entity.level.removeEntity(entity)
 
     def exitState(self, entity):
         return
 
 # QuestionBlockStateIdle
 class QuestionBlockStateIdle (State):
+    sleeps = True
+
+    def hitBy (self, entity, mario, sides):
+        # If Mario jumped up and collided with block.
+        if mario.y > entity.y:
+            entity.changeState("hit")
+
+    contactHandlers = { (Tile, Mario):"hitBy" }
+
     def enterState (self, entity):
         return
 
     def execute (self, entity, deltaTime):
-        if entity.hasCollision:
-            for tile in entity.collidingObjects:
-                # If Mario jumped up and collided with block.
-                if isinstance(tile, Mario) and tile.y > entity.y:
-                    entity.changeState("hit")
-            entity.hasCollision = False
-            entity.collidingObjects = []
+        entity.handleContacts(self.contactTable)
+        entity.clearCollisions()
 
     def exitState(self, entity):
         return
 
 # QuestionBlockStateHit
 class QuestionBlockStateHit (State):
+    sleeps = True
+
     def enterState (self, entity):
         entity.color = grey
+        entity.level.tileChanged(entity)
         if not entity.used:
             entity.used = True
             if entity.contents == "coin":
-                for obj in level.entities:
-                    if isinstance(obj, Coin):
-                        obj.setX(entity.x + 20)
-                        obj.setY(entity.y - tileWidth)
-                        obj.changeState("idle")
+                for obj in entity.level.entitiesOf(Coin):
+                    obj.setX(entity.x + 20)
+                    obj.setY(entity.y - tileWidth)
+                    obj.changeState("idle")
 
             elif entity.contents == "mushroom":
-                for obj in level.entities:
-                    if isinstance(obj, Mushroom):
-                        obj.setX(entity.x)
-                        obj.setY(entity.y)
-                        obj.changeState("spawn")
+                for obj in entity.level.entitiesOf(Mushroom):
+                    obj.setX(entity.x)
+                    obj.setY(entity.y)
+                    obj.changeState("spawn")
                     
     def execute (self, entity, deltaTime):
-        return
+        entity.clearCollisions()
 
     def exitState (self, entity):
         return
 
 # BrickBlockStateIdle
 class BrickBlockStateIdle (State):
+    sleeps = True
+
+    def hitBy (self, entity, mario, sides):
+        # If Mario jumped up and collided with block.
+        if mario.y > entity.y:
+            entity.changeState("hitLight")
+
+    contactHandlers = { (Tile, Mario):"hitBy" }
+
     def enterState (self, entity):
         return
 
     def execute (self, entity, deltaTime):
-        if entity.hasCollision:
-            for tile in entity.collidingObjects:
-                sides = collision_sides(entity.rect, tile.rect)
-                # If Mario jumped up and collided with block.
-                if isinstance(tile, Mario) and tile.y > entity.y:
-                    entity.changeState("hitLight")
-            entity.hasCollision = False
-            entity.collidingObjects = []
+        entity.handleContacts(self.contactTable)
+        entity.clearCollisions()
 
     def exitState(self, entity):
         return
 
 # BrickBlockStateHitLight
-class BrickBlockStateHitLight:
+class BrickBlockStateHitLight (State):
     def enterState (self, entity):
-        self.done = False
-        self.startY = entity.y
-        self.maxY = entity.y - entity.h/2
-        self.step = -0.2
+        entity.startY = entity.y
+        entity.bumpStep = -0.2
+        entity.static = False
+        entity.level.tileChanged(entity)
 
     def execute (self, entity, deltaTime):
-        entity.setY(entity.y + self.step * deltaTime)
-        if entity.y <= self.maxY:
-            self.step *= -1
-        if entity.y >= self.startY:
-            entity.setY(self.startY)
+        # Contacts made during the bump mean nothing once it is over.
+        entity.clearCollisions()
+        entity.setY(entity.y + entity.bumpStep * deltaTime)
+        if entity.y <= entity.startY - entity.h/2:
+            entity.bumpStep *= -1
+        if entity.y >= entity.startY:
+            entity.setY(entity.startY)
             entity.changeState("idle")
 
     def exitState(self, entity):
-        return
+        entity.static = True
+        entity.level.tileChanged(entity)
 
 # GroundBlockStateIdle
 class GroundBlockStateIdle (State):
+    sleeps = True
+
     def enterState (self, entity):
         return
 
     def execute (self, entity, deltaTime):
-        return
+        entity.clearCollisions()
         
     def exitState(self, entity):
         return
 
 # PipeStateIdle
 class PipeStateIdle (State):
+    sleeps = True
+
     def enterState (self, entity):
         return
 
     def execute (self, entity, deltaTime):
-        if entity.hasCollision:
-            entity.hasCollision = False
-            entity.collidingObjects = []
+        entity.clearCollisions()
         
     def exitState(self, entity):
         return
 
 # CoinStateIdle
 class CoinStateIdle (State):
+    delay = 1000
+
     def enterState (self, entity):
         entity.active = True
-        self.timer = 0
-        self.delay = 1000
+        entity.stateTime = 0
 
     def execute (self, entity, deltaTime):
-        self.timer += deltaTime
+        entity.stateTime += deltaTime
+        entity.clearCollisions()
 
-        if self.timer > self.delay:
+        if entity.stateTime > self.delay:
             entity.changeState("unused")
 
     def exitState(self, entity):
@@ -774,6 +1777,8 @@ class CoinStateIdle (State):
 
 # CoinStateUnused
 class CoinStateUnused (State):
+    sleeps = True
+
     def enterState (self, entity):
        entity.setX(-100)
        entity.setY(0)
@@ -789,12 +1794,15 @@ class CoinStateUnused (State):
 class MushroomStateSpawn (State):
     def enterState (self, entity):
        entity.active = True
-       self.startY = entity.y
+       entity.startY = entity.y
 
     def execute (self, entity, deltaTime):
         dy = 0.05 * deltaTime
         entity.translate(0, -dy)
-        if entity.y <= self.startY - tileWidth:
+        # Rising out of its block, it has nothing to react to yet; left
+        # over, these contacts would push it off the block once it moves.
+        entity.clearCollisions()
+        if entity.y <= entity.startY - tileWidth:
             entity.direction = "right"
             entity.changeState("move")
 
@@ -802,7 +1810,18 @@ class MushroomStateSpawn (State):
         return
 
 # MushroomStateMove
-class MushroomStateMove (State):
+class MushroomStateMove (WalkState):
+    def takenBy (self, entity, mario, sides):
+        # That something was Mario.
+        if sides & sideTop:
+            entity.active = False
+            entity.setX(-100)
+            entity.setY(100)
+            entity.changeState("spawn")
+        self.turnAround(entity, mario, sides)
+
+    contactHandlers = { (Mushroom, Mario):"takenBy", (Mushroom, None):"turnAround" }
+
     def enterState (self, entity):
         return
 
@@ -818,32 +1837,14 @@ class MushroomStateMove (State):
             entity.changeState("fall")
 
         # Check for move into something.
-        if entity.hasCollision:
-            for tile in entity.collidingObjects:
-                sides = collision_sides(entity.rect, tile.rect)
-                
-                # That something was Mario.
-                if sides.top and isinstance(tile, Mario):
-                    entity.active = False
-                    entity.setX(-100)
-                    entity.setY(100)
-                    entity.changeState("spawn")
-                    
-                if sides.left:
-                    entity.setX(tile.x + tile.w)
-                    entity.direction = "right"
-                elif sides.right:
-                    entity.setX(tile.x - entity.w)
-                    entity.direction = "left"
-                
-            entity.hasCollision = False
-            entity.collidingObjects = []
+        entity.handleContacts(self.contactTable)
+        entity.clearCollisions()
 
     def exitState(self, entity):
         return
 
 # MushroomStateFall
-class MushroomStateFall (State):
+class MushroomStateFall (FallState):
     def enterState (self, entity):
         entity.velocity = 0
 
@@ -855,7 +1856,7 @@ class MushroomStateFall (State):
             entity.translate(0.15 * deltaTime, 0)
 
         # Update Y
-        landed = updateFall(entity, deltaTime)
+        landed = self.updateFall(entity, deltaTime)
 
         # Check land
         if landed:
@@ -868,122 +1869,752 @@ class MushroomStateFall (State):
 # Levels
 ####################################
 
+# TextLevelSource
+# Reads the text level format, one character per tile as in 1-1.txt. This
+# is what levels are written in; compile_level turns it into the binary
+# format below.
+class TextLevelSource (object):
+    def __init__ (self, fileHandle):
+        with open(fileHandle) as f:
+            self.tileRows = [row.rstrip("\n") for row in f]
+        self.columns = max([len(row) for row in self.tileRows] + [0])
+        self.rows = len(self.tileRows)
+
+    def entities (self):
+        # (symbol, column, row) for Mario and every enemy.
+        for y, row in enumerate(self.tileRows):
+            for x, tile in enumerate(row):
+                if tile in entityTiles:
+                    yield tile, x, y
+
+    def cells (self, first, last):
+        # (symbol, column, row) for every tile in columns first to last - 1.
+        for y, row in enumerate(self.tileRows):
+            for x in range(first, min(last, len(row))):
+                if row[x] != blankTile and row[x] not in entityTiles:
+                    yield row[x], x, y
+
+    def tiles (self, first, last):
+        # (symbol, column, row, columns, rows) for the tiles in columns
+        # first to last - 1, merged as merge_tiles does.
+        return merge_tiles(self.cells(first, last))
+
+# BinaryLevelSource
+# Reads a level written by compile_level through mmap: a header, where
+# each chunk's tiles start, the tiles of each levelChunkColumns wide chunk
+# as merge_tiles gives them for that chunk, the ground and pipes as merged
+# across the whole level and a table of entities. Tiles are stored just
+# as sources hand them out, so a chunk or the whole level is read straight
+# out of the file without touching the rest of it or merging anything
+# again. The file is closed once mapped, but the map stays open as long
+# as the source does, since streamed levels go on reading chunks out of
+# it while they are played; close() unmaps it once nothing reads from it.
+class BinaryLevelSource (object):
+    def __init__ (self, fileHandle):
+        with open(fileHandle, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = levelMagicVersion.unpack_from(self.data, 0)
+        if magic != levelMagic or version != levelVersion:
+            raise ValueError("%s is not a version %d compiled level" % (fileHandle, levelVersion))
+        (magic, version, self.rows, self.columns, self.chunkColumns,
+         self.levelRectCount, self.entityCount) = levelHeader.unpack_from(self.data, 0)
+        self.chunks = (self.columns + self.chunkColumns - 1) // self.chunkColumns
+        self.offsetStart = levelHeader.size
+        self.rectStart = self.offsetStart + levelOffset.size * (self.chunks + 1)
+        self.levelRectStart = self.rectStart + levelChunkRect.size * self.chunkOffset(self.chunks)
+        self.entityStart = self.levelRectStart + levelRect.size * self.levelRectCount
+
+    def close (self):
+        self.data.close()
+
+    def chunkOffset (self, index):
+        return levelOffset.unpack_from(self.data, self.offsetStart + levelOffset.size * index)[0]
+
+    def entities (self):
+        for i in range(self.entityCount):
+            symbol, x, y = levelEntity.unpack_from(self.data, self.entityStart + levelEntity.size * i)
+            yield chr(symbol), x, y
+
+    def chunkTiles (self, index):
+        # Chunk rects are all bytes, so a whole chunk is read in one slice.
+        left = index * self.chunkColumns
+        size = levelChunkRect.size
+        data = bytearray(self.data[self.rectStart + size * self.chunkOffset(index):self.rectStart + size * self.chunkOffset(index + 1)])
+        for i in range(0, len(data), size):
+            yield chr(data[i]), left + data[i + 1], data[i + 2], data[i + 3], data[i + 4]
+
+    def tiles (self, first, last):
+        # The same rects, in the same order, as TextLevelSource.tiles.
+        first = max(first, 0)
+        last = min(last, self.columns)
+        if first >= last:
+            return
+        chunkColumns = self.chunkColumns
+        if first == 0 and last == self.columns:
+            # Single tiles come in row order, as in the text file.
+            single = [rect for index in range(self.chunks) for rect in self.chunkTiles(index) if rect[0] not in mergedTiles]
+            single.sort(key=lambda rect: (rect[2], rect[1]))
+            for rect in single:
+                yield rect
+            for i in range(self.levelRectCount):
+                symbol, x, y, columns, rows = levelRect.unpack_from(self.data, self.levelRectStart + levelRect.size * i)
+                yield chr(symbol), x, y, columns, rows
+        elif first % chunkColumns == 0 and last == min(first + chunkColumns, self.columns):
+            for rect in self.chunkTiles(first // chunkColumns):
+                yield rect
+        else:
+            # Any other range is cut out of its chunks and merged again.
+            cells = []
+            for index in range(first // chunkColumns, (last - 1) // chunkColumns + 1):
+                for tile, x, y, columns, rows in self.chunkTiles(index):
+                    for column in range(max(x, first), min(x + columns, last)):
+                        for row in range(y, y + rows):
+                            cells.append((tile, column, row))
+            cells.sort(key=lambda cell: (cell[2], cell[1]))
+            for rect in merge_tiles(cells):
+                yield rect
+
+# LevelSnapshot
+# The state of a Level at one physics step: its counters and camera
+# (values), which entities, awake tiles and moving tiles it has, and the
+# fields of its objects (states, one tuple per object from
+# capture_entity). RewindBuffer keeps partial ones, holding only the
+# objects that changed and None for lists that didn't.
+class LevelSnapshot (object):
+    __slots__ = ("values", "entities", "awakeTiles", "movingTiles", "states")
+
+    def __init__ (self, values, entities, awakeTiles, movingTiles, states):
+        self.values = values
+        self.entities = entities
+        self.awakeTiles = awakeTiles
+        self.movingTiles = movingTiles
+        self.states = states
+
 # Level
 class Level:
     
-    def __init__ (self, fileHandle):
-        self.f = open(fileHandle)
-        self.tileRows = self.f.readlines()
+    def __init__ (self, fileHandle, enemyStore=False, stream=False):
+        self.source = open_level_source(fileHandle)
+        self.columns = self.source.columns
+        self.width = self.columns * tileWidth
+        self.height = self.source.rows * tileWidth
+        self.enemyStore = None
+        if enemyStore:
+            self.enemyStore = EnemyStore(self.columns, self.source.rows)
         self.map = []
         self.entities = []
-        i = 0
-        for row in self.tileRows:
-            j = 0
-            for tile in row:
-                self.loadItem(tile, j, i)
-                j += 1
-            i += 1
+        self.kinds = {}
+        self.mario = None
+        self.spawnQueue = []
+        self.nextSpawn = 0
+        self.stream = stream
+        self.loadedChunks = set()
+        self.usedBlocks = set()
+        # Items from the file take their cell index as load order, so they
+        # keep the same update order however they are loaded.
+        self.loadCount = self.source.rows * self.columns
+        self.inputs = noInput
+        self.stepCount = 0
+        # How Mario left the level this step (see World.leave), and the
+        # pipe he went down.
+        self.exit = None
+        self.pipe = None
+        self.profiler = None
+        self.camera = None
+        self.cullMargin = cullMargin
+        self.tileGrid = SpatialGrid(tileWidth)
+        self.entityGrid = SpatialGrid(entityCellSize)
+        self.tileLayer = TileLayer(self, tileChunkColumns)
+        self.renderQueue = RenderQueue()
+        self.contacts = ContactBuffer()
+        self.movingTiles = []
+        self.awakeTiles = []
+        for tile, x, y in self.source.entities():
+            self.loadItem(tile, x, y)
+        if stream:
+            self.streamChunks()
+        else:
+            self.loadTiles(self.source.tiles(0, self.columns))
 
         # Add reusable items.
-        self.entities.append(Coin(-100, 0, 10, 30, coinColor))
-        self.entities.append(Mushroom(-100, 100, tileWidth, tileWidth, mushroomColor))
-        #self.entities.append(Star(-100, 200, tileWidth, tileWidth, starColor))
-        #self.entities.append(OneUp(-100, 300, tileWidth, tileWidth, oneUpColor))
-        #self.entities.append(Flower(-100, 400, tileWidth, tileWidth, flowerColor))
-
-    def loadItem (self, tile, x, y):
+        self.addEntity(Coin(-100, 0, 10, 30, coinColor))
+        self.addEntity(Mushroom(-100, 100, tileWidth, tileWidth, mushroomColor))
+        #self.addEntity(Star(-100, 200, tileWidth, tileWidth, starColor))
+        #self.addEntity(OneUp(-100, 300, tileWidth, tileWidth, oneUpColor))
+        #self.addEntity(Flower(-100, 400, tileWidth, tileWidth, flowerColor))
+
+    def loadTiles (self, tiles):
+        # tiles are (symbol, column, row, columns, rows) rects from the
+        # level source, ground and pipes already merged (see merge_tiles).
+        for tile, x, y, columns, rows in tiles:
+            self.loadItem(tile, x, y, columns, rows)
+
+    def loadItem (self, tile, x, y, columns=1, rows=1):
         xPos = x * tileWidth
         yPos = y * tileWidth
+        loadOrder = y * self.columns + x
 
         if (tile == blankTile):
             return
         
         elif (tile == groundTile):
-            self.map.append(GroundBlock(xPos, yPos, tileWidth, tileWidth, groundBrown))
+            self.addTile(GroundBlock(xPos, yPos, tileWidth * columns, tileWidth * rows, groundBrown), loadOrder)
 
         elif (tile == marioTile):
-            self.entities.append(Mario(xPos, yPos+10, tileWidth-10, tileWidth-10, white))
+            self.addEntity(Mario(xPos, yPos+10, tileWidth-10, tileWidth-10, white), loadOrder)
 
         elif (tile == blockTile):
-            self.map.append(BrickBlock(xPos, yPos, tileWidth, tileWidth, brickBrown))
+            self.addTile(BrickBlock(xPos, yPos, tileWidth, tileWidth, brickBrown), loadOrder)
 
         elif (tile == qCoinTile):
-            self.map.append(QuestionBlock(xPos, yPos, tileWidth, tileWidth, "coin", gold))
+            self.addTile(self.makeQuestionBlock(xPos, yPos, "coin"), loadOrder)
 
         elif (tile == qMushTile):
-            self.map.append(QuestionBlock(xPos, yPos, tileWidth, tileWidth, "mushroom", gold))
+            self.addTile(self.makeQuestionBlock(xPos, yPos, "mushroom"), loadOrder)
 
         elif (tile == pipeTile):
-            self.map.append(Pipe(xPos, yPos, tileWidth, tileWidth, green))
+            self.addTile(Pipe(xPos, yPos, tileWidth * columns, tileWidth * rows, green), loadOrder)
 
         elif (tile == goombaTile):
-            self.entities.append(Goomba(xPos, yPos, tileWidth, tileWidth, xPos - screenSize[0]/2, goombaColor))
+            self.addSpawn(Goomba, xPos, yPos, goombaColor, loadOrder)
 
         elif (tile == koopaTile):
-            self.entities.append(Koopa(xPos, yPos, tileWidth, tileWidth, xPos - screenSize[0]/2, koopaColor))
+            self.addSpawn(Koopa, xPos, yPos, koopaColor, loadOrder)
+
+    def makeQuestionBlock (self, x, y, contents):
+        # A block used before its chunk was evicted comes back used.
+        block = QuestionBlock(x, y, tileWidth, tileWidth, contents, gold)
+        if (x, y) in self.usedBlocks:
+            block.used = True
+            block.color = grey
+            block.currState = block.allStates.get("hit")
+        return block
+
+    def streamChunks (self):
+        # Keep the level chunks under the view built, plus one either side,
+        # and evict those further than two chunks out. An evicted chunk is
+        # rebuilt from the level source if the view comes back to it.
+        chunkWidth = levelChunkColumns * tileWidth
+        if self.camera is not None:
+            left, right = self.camera.x, self.camera.x + self.camera.w
+        elif self.mario is not None:
+            left, right = self.mario.x - screenSize[0]/2, self.mario.x + screenSize[0]/2
+        else:
+            return
+        first = int(left // chunkWidth) - 1
+        last = int((right - 1) // chunkWidth) + 1
+        for index in range(max(first, 0), min(last, (self.columns - 1) // levelChunkColumns) + 1):
+            if index not in self.loadedChunks:
+                self.loadChunk(index)
+        for index in list(self.loadedChunks):
+            if index < first - 1 or index > last + 1:
+                self.evictChunk(index)
+
+    def loadChunk (self, index):
+        self.loadedChunks.add(index)
+        first = index * levelChunkColumns
+        self.loadTiles(self.source.tiles(first, first + levelChunkColumns))
+
+    def evictChunk (self, index):
+        # Drops the chunk's tiles and any enemies inside it. Enemies are
+        # never spawned twice, so whatever happened to them sticks; used
+        # question blocks are remembered in usedBlocks.
+        self.loadedChunks.discard(index)
+        left = index * levelChunkColumns * tileWidth
+        right = left + levelChunkColumns * tileWidth
+        for tile in self.tileGrid.queryArea(left, 0, right, self.height):
+            if left <= tile.x < right:
+                if isinstance(tile, QuestionBlock) and tile.used:
+                    self.usedBlocks.add((tile.x, tile.y))
+                self.removeTile(tile)
+        for enemy in self.entityGrid.queryArea(left, -self.height, right, 2 * self.height):
+            if isinstance(enemy, Enemy) and left <= enemy.x and enemy.x + enemy.w <= right:
+                self.removeEntity(enemy)
+
+    def addSpawn (self, enemyClass, x, y, color, loadOrder):
+        # Enemies are only built once Mario gets within half a screen of
+        # them. Until then each is a tuple in spawnQueue, kept sorted by
+        # the x Mario has to pass, and costs nothing per step.
+        spawn = (x - screenSize[0]/2, loadOrder, enemyClass, x, y, color)
+        bisect.insort(self.spawnQueue, spawn, self.nextSpawn)
+
+    def spawnEnemies (self):
+        mario = self.mario
+        queue = self.spawnQueue
+        while mario is not None and self.nextSpawn < len(queue) and mario.x > queue[self.nextSpawn][0]:
+            spawnX, loadOrder, enemyClass, x, y, color = queue[self.nextSpawn]
+            self.nextSpawn += 1
+            enemy = self.makeEnemy(enemyClass, x, y, tileWidth, tileWidth, spawnX, color)
+            self.addEntity(enemy, loadOrder)
+            enemy.changeState("move")
+
+    def makeEnemy (self, enemyClass, *args):
+        if self.enemyStore is None:
+            return enemyClass(*args)
+        return storedEnemies[enemyClass](self.enemyStore, *args)
 
     def update (self, deltaTime):
-        for tile in self.map:
+        self.stepCount += 1
+        if self.stream:
+            self.streamChunks()
+
+        # Only awake tiles need updating; most of the map never does.
+        for tile in sorted(self.awakeTiles, key=load_order):
             tile.update(deltaTime)
-        for entity in self.entities:
-            entity.update(deltaTime)
-        
-        self.checkCollisions()
+            if tile.canSleep():
+                tile.awake = False
+        self.awakeTiles = [tile for tile in self.awakeTiles if tile.awake]
+
+        if self.enemyStore is not None:
+            self.enemyStore.step(self, deltaTime)
+
+        for entity in self.activeEntities():
+            if entity.awake:
+                entity.update(deltaTime)
+                # Skip ones that removed themselves in their update.
+                if entity.grid is not None and entity.canSleep():
+                    entity.awake = False
+
+        self.spawnEnemies()
+        profiler = self.profiler
+        if profiler is None:
+            self.checkCollisions()
+        else:
+            start = timer()
+            self.checkCollisions()
+            profiler.record("collision", start)
+
+        # Reaching the end of the level stands in for the flagpole.
+        mario = self.mario
+        if mario is not None and mario.x + mario.w >= self.width:
+            self.exit = exitFinish
+
+    def leaveByPipe (self, pipe):
+        self.exit = exitPipe
+        self.pipe = pipe
+
+    def comeBackUp (self):
+        # Back from the area a pipe leads to: Mario comes out next to the
+        # pipe he went down, standing on whatever it stands on.
+        mario = self.mario
+        pipe = self.pipe
+        if mario is not None and pipe is not None:
+            mario.setX(pipe.x + pipe.w)
+            mario.setY(pipe.y + pipe.h - mario.h)
+            mario.changeState("idle")
+        self.exit = None
+
+    def activeArea (self):
+        # The camera view grown by cullMargin on every side, or None to
+        # treat the whole level as active when there is no camera.
+        camera = self.camera
+        if camera is None:
+            return None
+        margin = self.cullMargin
+        return (camera.x - margin, camera.y - margin,
+                camera.x + camera.w + margin, camera.y + camera.h + margin)
+
+    def activeEntities (self):
+        # Looked up through the entity grid, so the cost follows what is
+        # near the camera rather than the size of the level. Sorted back
+        # into load order to keep updates in the same order every run.
+        area = self.activeArea()
+        if area is None:
+            return list(self.entities)
+        entities = self.entityGrid.queryArea(*area)
+        entities.sort(key=load_order)
+        return entities
 
     def checkCollisions (self):
-        for entity in self.entities:
-            # Check Mario/Entity collisions.
-            if not isinstance(entity, Mario):
-                mario = self.getMario()
-                if entity.rect.colliderect(mario.rect):
-                    entity.addCollision(mario)
-                    mario.addCollision(entity)
-
-            # Check Entity/World collisions.
-            for tile in self.map:
+        entities = self.activeEntities()
+
+        # Check Entity/Entity collisions.
+        for a, b in self.findEntityPairs(entities):
+            depth = contact_depth(a.rect, b.rect)
+            a.addCollision(b, contact_sides(a.rect, b.rect), depth)
+            b.addCollision(a, contact_sides(b.rect, a.rect), depth)
+
+        for entity in entities:
+            # Check Entity/World collisions against the tiles in the
+            # grid cells this entity overlaps.
+            for tile in self.tileGrid.query(entity.rect):
                 if tile.rect.colliderect(entity.rect):
-                    entity.addCollision(tile)
-                    tile.addCollision(entity)
+                    depth = contact_depth(entity.rect, tile.rect)
+                    entity.addCollision(tile, contact_sides(entity.rect, tile.rect), depth)
+                    tile.addCollision(entity, contact_sides(tile.rect, entity.rect), depth)
+
+    def findEntityPairs (self, entities):
+        # Sort and sweep along x. With the active entities ordered by
+        # their left edge, each one only needs testing against those that
+        # start before it ends, which keeps this near O(n log n).
+        active = [entity for entity in entities if entity.isActive()]
+        active.sort(key=rect_left)
+        pairs = []
+        count = len(active)
+        for i in range(count):
+            a = active[i]
+            right = a.rect.right
+            j = i + 1
+            while j < count and active[j].rect.left < right:
+                b = active[j]
+                if a.rect.colliderect(b.rect):
+                    pairs.append((a, b))
+                j += 1
+        return pairs
+
+    def sweepMove (self, entity, dx, dy):
+        # Resolve moving entity by (dx, dy) against the map. The entity stops
+        # flush against the first tile it would hit and slides along it for
+        # the rest of the move. Each hit is recorded as a contact on both
+        # sides, so states see it just like an overlap found by
+        # checkCollisions. Returns the displacement that is actually free.
+        x, y, w, h = entity.x, entity.y, entity.w, entity.h
+        for attempt in range(2):
+            if dx == 0 and dy == 0:
+                break
+            left = min(x, x + dx)
+            top = min(y, y + dy)
+            right = max(x + w, x + w + dx)
+            bottom = max(y + h, y + h + dy)
+
+            # Grow the area by a pixel to catch tiles just touching it.
+            hit = None
+            for tile in self.tileGrid.queryArea(left - 1, top - 1, right + 1, bottom + 1):
+                if tile is entity:
+                    continue
+                impact = sweep_aabb(x, y, w, h, dx, dy, tile)
+                if impact is not None and (hit is None or impact[0] < hit[0]):
+                    hit = impact + (tile,)
+            if hit is None:
+                x += dx
+                y += dy
+                break
+
+            time, normalX, normalY, tile = hit
+            if normalX != 0:
+                x = tile.x + tile.w if normalX > 0 else tile.x - w
+                y += dy * time
+                dx = 0
+                dy *= 1 - time
+                sides = sideLeft if normalX > 0 else sideRight
+                tileSides = sideRight if normalX > 0 else sideLeft
+            else:
+                y = tile.y + tile.h if normalY > 0 else tile.y - h
+                x += dx * time
+                dx *= 1 - time
+                dy = 0
+                sides = sideTop if normalY > 0 else sideBottom
+                tileSides = sideBottom if normalY > 0 else sideTop
+            entity.addCollision(tile, sides, 0)
+            tile.addCollision(entity, tileSides, 0)
+        else:
+            x += dx
+            y += dy
+        return x - entity.x, y - entity.y
 
     def removeEntity (self, entity):
         self.entities.remove(entity)
+        for kind in entity_kinds(entity):
+            self.kinds[kind].remove(entity)
+        if entity is self.mario:
+            marios = self.entitiesOf(Mario)
+            self.mario = marios[0] if marios else None
+        self.entityGrid.remove(entity)
+        entity.grid = None
+        if isinstance(entity, EnemyView):
+            entity.store.release(entity)
 
     def removeTile (self, tile):
         self.map.remove(tile)
-
-    def addEntity (self, entity):
+        self.tileGrid.remove(tile)
+        self.tileLayer.invalidate(tile)
+        if tile in self.movingTiles:
+            self.movingTiles.remove(tile)
+        if tile in self.awakeTiles:
+            self.awakeTiles.remove(tile)
+        tile.grid = None
+        if self.enemyStore is not None:
+            self.enemyStore.setSolid(tile, False)
+
+    def wake (self, obj):
+        # Entities are looked up through the entity grid each step and only
+        # need their awake flag; tiles are tracked here.
+        if isinstance(obj, Tile) and obj not in self.awakeTiles:
+            self.awakeTiles.append(obj)
+
+    def tileChanged (self, tile):
+        # Called when a tile's look or position changes. Tiles that are not
+        # static are drawn every frame until they settle again.
+        self.tileLayer.invalidate(tile)
+        if not tile.static and tile not in self.movingTiles:
+            self.movingTiles.append(tile)
+        elif tile.static and tile in self.movingTiles:
+            self.movingTiles.remove(tile)
+
+    def addTile (self, tile, loadOrder=None):
+        if loadOrder is None:
+            loadOrder = self.loadCount
+            self.loadCount += 1
+        self.map.append(tile)
+        self.tileGrid.insert(tile)
+        self.tileLayer.invalidate(tile)
+        tile.grid = self.tileGrid
+        tile.level = self
+        if self.enemyStore is not None:
+            self.enemyStore.setSolid(tile, True)
+        tile.loadOrder = loadOrder
+        if tile.awake:
+            self.awakeTiles.append(tile)
+
+    def addEntity (self, entity, loadOrder=None):
+        # loadOrder lets an entity built after loading, such as a queued
+        # enemy, keep its place in the update order.
+        if loadOrder is None:
+            loadOrder = self.loadCount
+            self.loadCount += 1
         self.entities.append(entity)
+        for kind in entity_kinds(entity):
+            self.kinds.setdefault(kind, []).append(entity)
+        if self.mario is None and isinstance(entity, Mario):
+            self.mario = entity
+        self.entityGrid.insert(entity)
+        entity.grid = self.entityGrid
+        entity.level = self
+        entity.loadOrder = loadOrder
                 
-    def getMario (self):
-        for entity in self.entities:
-            if isinstance(entity, Mario):
-                return entity
-        return None
-
-    def draw (self):
+    def snapshotValues (self):
+        camera = self.camera
+        return (self.stepCount, self.nextSpawn, self.loadCount, self.mario,
+                camera.x, camera.y, camera.prevX, camera.prevY)
+
+    def snapshot (self):
+        # Everything needed to put the level back as it is now. Streamed
+        # levels and the enemy store build and free objects and rows behind
+        # the level's back, so only levels built whole with plain enemies
+        # can be snapshotted.
+        if self.stream or self.enemyStore is not None:
+            raise ValueError("only levels built whole without the enemy store can be snapshotted")
+        states = dict((obj, capture_entity(obj)) for obj in self.entities)
         for tile in self.map:
-            tile.draw()
-        for entity in self.entities:
-            entity.draw()
+            states[tile] = capture_entity(tile)
+        return LevelSnapshot(self.snapshotValues(), list(self.entities), list(self.awakeTiles), list(self.movingTiles), states)
+
+    def restore (self, snapshot):
+        # Put back what snapshot holds, which may be a partial snapshot.
+        added = ()
+        if snapshot.entities is not None:
+            saved = set(snapshot.entities)
+            for entity in self.entities:
+                if entity not in saved:
+                    self.entityGrid.remove(entity)
+                    entity.grid = None
+            current = set(self.entities)
+            added = [entity for entity in snapshot.entities if entity not in current]
+            self.entities = list(snapshot.entities)
+            self.kinds = {}
+            for entity in self.entities:
+                for kind in entity_kinds(entity):
+                    self.kinds.setdefault(kind, []).append(entity)
+        if snapshot.awakeTiles is not None:
+            self.awakeTiles = list(snapshot.awakeTiles)
+        if snapshot.movingTiles is not None:
+            self.movingTiles = list(snapshot.movingTiles)
+
+        for obj, values in snapshot.states.items():
+            restore_entity(obj, values)
+            if isinstance(obj, Tile):
+                self.tileLayer.invalidate(obj)
+        for entity in added:
+            self.entityGrid.insert(entity)
+            entity.grid = self.entityGrid
+
+        camera = self.camera
+        (self.stepCount, self.nextSpawn, self.loadCount, self.mario,
+         camera.x, camera.y, camera.prevX, camera.prevY) = snapshot.values
+
+    def getMario (self):
+        return self.mario
+
+    def entitiesOf (self, kind):
+        # Every entity that is an instance of kind, in the order added.
+        # Kept up to date by addEntity and removeEntity; don't modify it.
+        return self.kinds.get(kind, noEntities)
+
+    def draw (self, screen, camera):
+        self.tileLayer.draw(screen, camera)
+        queue = self.renderQueue
+        alpha = camera.alpha
+        for tile in self.movingTiles:
+            tile.draw(queue, alpha)
+
+        # Only the entities in view, with a tile of slack for the ones
+        # drawn between their last two physics steps.
+        entities = self.entityGrid.queryArea(camera.viewX - tileWidth, camera.viewY - tileWidth,
+                                             camera.viewX + camera.w + tileWidth, camera.viewY + camera.h + tileWidth)
+        entities.sort(key=load_order)
+        for entity in entities:
+            entity.draw(queue, alpha)
+        queue.flush(screen, camera)
 
 # 1-1
 class LevelOneOne (Level):
-    def __init__ (self, fileHandle):
-        Level.__init__(self, fileHandle)
+    def __init__ (self, fileHandle, enemyStore=False, stream=False):
+        Level.__init__(self, fileHandle, enemyStore, stream)
 
     def update (self, deltaTime):
         Level.update(self, deltaTime)
         return
 
+# LevelCache
+# The capacity most recently used level sources, keyed by what they were
+# opened from. Sources are only read from once open, so any number of
+# Levels can be built from one, on any thread, and restarting or coming
+# back to a level never goes back to disk or parses it again.
+class LevelCache (object):
+    def __init__ (self, capacity=None):
+        if capacity is None:
+            capacity = levelCacheSize
+        self.capacity = capacity
+        self.sources = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get (self, fileHandle):
+        with self.lock:
+            source = self.sources.pop(fileHandle, None)
+            if source is not None:
+                self.sources[fileHandle] = source
+                return source
+        # Read outside the lock so a slow file doesn't hold up the rest.
+        source = open_level_source(fileHandle)
+        with self.lock:
+            self.sources[fileHandle] = source
+            while len(self.sources) > self.capacity:
+                self.sources.popitem(last=False)
+        return source
+
+# LevelLoader
+# Builds one of a World's levels on a background thread. take() waits for
+# it if it isn't done yet and returns it, raising whatever building it
+# raised.
+class LevelLoader (object):
+    def __init__ (self, world, fileHandle):
+        self.level = None
+        self.error = None
+        self.thread = threading.Thread(target=self.load, args=(world, fileHandle))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def load (self, world, fileHandle):
+        try:
+            self.level = world.build(fileHandle)
+        except Exception as e:
+            self.error = e
+
+    def take (self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.level
+
+# World
+# Levels played one after another. levels is a list of (level, area)
+# file handles, area being the level its pipes lead to, or None. Finishing
+# a level moves on to the next one, and going down a pipe to its area;
+# either way out of an area goes back up the pipe. Whenever a level
+# starts, wherever it can lead, itself included, is built on background
+# threads, so moving on or restarting is only a swap. Without preloading,
+# as for games that are thrown away after one run, levels are only built
+# when they are played.
+class World (object):
+    def __init__ (self, levels, enemyStore=False, stream=False, cacheSize=None, preloading=True):
+        self.levels = levels
+        self.enemyStore = enemyStore
+        self.stream = stream
+        self.preloading = preloading
+        self.cache = LevelCache(cacheSize)
+        self.loaders = {}
+        self.index = 0
+        # Levels left down a pipe, to come back up to.
+        self.parents = []
+
+    def build (self, fileHandle):
+        return LevelOneOne(self.cache.get(fileHandle), self.enemyStore, self.stream)
+
+    def take (self, fileHandle):
+        loader = self.loaders.pop(fileHandle, None)
+        if loader is None:
+            return self.build(fileHandle)
+        return loader.take()
+
+    def preload (self, fileHandle):
+        if self.preloading and fileHandle is not None and fileHandle not in self.loaders:
+            self.loaders[fileHandle] = LevelLoader(self, fileHandle)
+
+    def upcoming (self):
+        # Every level that can be played next from levels[index]: a spare
+        # copy of it for restarting, the next level and its area.
+        fileHandle, area = self.levels[self.index]
+        handles = [fileHandle]
+        if self.index + 1 < len(self.levels):
+            handles.append(self.levels[self.index + 1][0])
+        if area is not None:
+            handles.append(area)
+        return handles
+
+    def preloadNext (self):
+        # Loaders left over from other levels are dropped; their threads
+        # finish on their own and what they built is thrown away.
+        handles = self.upcoming()
+        for fileHandle in list(self.loaders):
+            if fileHandle not in handles:
+                del self.loaders[fileHandle]
+        for fileHandle in handles:
+            self.preload(fileHandle)
+
+    def start (self, index=0):
+        # A fresh copy of levels[index], also for restarting it.
+        self.index = index
+        self.parents = []
+        level = self.take(self.levels[index][0])
+        self.preloadNext()
+        return level
+
+    def leave (self, level, exit):
+        # The level to play once level is left by exit: the next level,
+        # the area or the level above it, level itself if a pipe leads
+        # nowhere, or None past the last level.
+        if self.parents:
+            parent = self.parents.pop()
+            parent.comeBackUp()
+            # Ready for going down the pipe again.
+            self.preloadNext()
+            return parent
+        if exit == exitPipe:
+            area = self.levels[self.index][1]
+            if area is None:
+                level.exit = None
+                return level
+            self.parents.append(level)
+            return self.take(area)
+        if self.index + 1 == len(self.levels):
+            return None
+        return self.start(self.index + 1)
+
 
 ####################################
 # Globals
 ####################################
 
 # Display
-pygame.init()
 screenSize = [1280,720]
 screenBGColor = lightBlue
+tileChunkColumns = 16
+
+# Contact sides
+sideLeft = 1
+sideRight = 2
+sideTop = 4
+sideBottom = 8
 
 # Tiles
 tileWidth = 50
@@ -998,130 +2629,753 @@ qCoinTile = '-'
 qMushTile = '1'
 qOneUpTile = '2'
 qStarTile = '3'
+entityTiles = (marioTile, goombaTile, koopaTile)
+mergedTiles = (groundTile, pipeTile)
+
+# Streaming
+# With streaming on, levels build their tiles levelChunkColumns columns at
+# a time around the view instead of all at once.
+levelChunkColumns = 16
+
+# Culling
+# Only objects within cullMargin pixels of the camera view are updated.
+cullMargin = 4 * tileWidth
+entityCellSize = 4 * tileWidth
+
+# Enemies
+# With enemyStore on, Goombas and Koopas are created as the stored classes
+# and their state is kept as an index into enemyStateNames.
+enemySpeed = 0.1
+enemyStateNames = ["wait", "move", "fall", "stomped", "shellMove", "knocked"]
+enemyStateIds = dict((name, i) for i, name in enumerate(enemyStateNames))
+storedEnemies = { Goomba:StoredGoomba, Koopa:StoredKoopa }
 
 # Levels
-levelHandle = "1-1.txt"
-level = LevelOneOne(levelHandle)
+levelHandle = os.path.join(os.path.dirname(os.path.abspath(__file__)), "1-1.txt")
+
+# Worlds
+# A level file ending in worldSuffix is a world file (see load_world).
+# World keeps the last levelCacheSize level sources it read. restartKey
+# starts the current level over.
+worldSuffix = ".world"
+levelCacheSize = 4
+restartKey = K_RETURN
+exitFinish = "finish"
+exitPipe = "pipe"
+
+# Compiled levels
+# Layout read by BinaryLevelSource and written by compile_level, all
+# little-endian: a header (magic, version, rows, columns, chunk columns,
+# level rect count, entity count), chunks + 1 chunk offsets, (symbol,
+# column in chunk, row, columns, rows) chunk rects, (symbol, column, row,
+# columns, rows) level rects and (symbol, column, row) entities. Rows and
+# chunk columns have to fit in a byte.
+levelMagic = b"SMBL"
+levelVersion = 1
+levelMagicVersion = struct.Struct("<4sH")
+levelHeader = struct.Struct("<4sHHIHII")
+levelOffset = struct.Struct("<I")
+levelChunkRect = struct.Struct("<BBBBB")
+levelRect = struct.Struct("<BIBIB")
+levelEntity = struct.Struct("<BIB")
 
 # Physics
+# gravity and jump impulses are tuned per physicsStep milliseconds. See
+# fall_distance for how other step lengths are handled.
 gravity = 0.02
 maxVelocity = 1
-
-# Game
-screen = pygame.display.set_mode(screenSize)
-pygame.display.set_caption("SMB")
-camera = Camera()
-clock = pygame.time.Clock()
-running = True
+physicsRate = 60
+physicsStep = 1000.0 / physicsRate
+maxStepsPerFrame = 5
+
+# Input
+# The only keys the game reads. Inputs keeps one bit for each.
+gameKeys = [K_a, K_d, K_SPACE, K_LSHIFT, K_s]
+gameKeyBits = dict((key, 1 << i) for i, key in enumerate(gameKeys))
+noInput = Inputs()
+
+# Input recordings
+# A header (magic, version, physics rate, max steps per frame, option
+# flags, SHA-1 of the level) and then a (frame time in ms, key mask)
+# record per frame, little-endian.
+inputMagic = b"SMBI"
+inputVersion = 2
+inputMagicVersion = struct.Struct("<4sH")
+inputHeader = struct.Struct("<4sHdHB20s")
+inputFrame = struct.Struct("<dH")
+inputEnemyStore = 1
+inputStream = 2
+
+# Rewind
+# Holding rewindKey steps the game back one physics step per frame, up to
+# rewindFrames steps. Snapshots save every slot of an entity except the
+# ones in snapshotSkip: links fixed for its lifetime, the rect rebuilt from
+# its position, and the ends of its chain of contacts, which are copied
+# out of the level's ContactBuffer instead.
+rewindKey = K_r
+rewindFrames = 3 * 60 * physicsRate
+snapshotSkip = ("rect", "grid", "level", "loadOrder", "allStates", "contactHead", "contactTail")
+snapshotFields = {}
+
+# Profiling
+# Phases of a frame timed by FrameProfiler, in the order they are stacked
+# on the overlay. profilerKey shows and hides the overlay and
+# profilerTraceKey writes the Chrome trace.
+timer = time.perf_counter
+profilerPhases = ["events", "tick", "update", "collision", "draw", "flip"]
+profilerColors = { "events":grey, "tick":[100,149,237], "update":green, "collision":red, "draw":gold, "flip":lightBlue }
+profilerPercentiles = [50, 95, 99]
+profilerFrames = 600
+profilerSpansPerFrame = 16
+profilerBudgetMs = 1000.0 / 60
+profilerGraphMs = 2 * profilerBudgetMs
+profilerOverlaySize = [400, 220]
+profilerKey = K_F3
+profilerTraceKey = K_F4
+profilerTraceHandle = "trace.json"
+
+# Contacts
+# The kinds of object contact handlers are chosen by (see
+# State.contactHandlers). Each entity class counts as the first kind it
+# derives from.
+contactKinds = [Mario, Enemy, Tile, Coin, Mushroom]
+for kind, cls in enumerate(contactKinds):
+    cls.contactKind = kind
+
+# States
+# One shared instance of each State per kind of object. States keep
+# nothing between calls; whatever they track lives on the entity.
+noStates = {}
+noEntities = ()
+marioStates = { "idle":MarioStateIdle(), "move":MarioStateMove(), "jump":MarioStateJump(), "fall":MarioStateFall() }
+enemyStateWait = EnemyStateWait()
+enemyStateMove = EnemyStateMove()
+enemyStateFall = EnemyStateFall()
+enemyStateKnocked = EnemyStateKnocked()
+goombaStates = { "wait":enemyStateWait, "move":enemyStateMove, "fall":enemyStateFall, "stomped":GoombaStateStomped(), "knocked":enemyStateKnocked }
+koopaStates = { "wait":enemyStateWait, "move":enemyStateMove, "fall":enemyStateFall, "stomped":KoopaStateStomped(), "shellMove":KoopaStateShellMove(), "knocked":enemyStateKnocked }
+coinStates = { "idle":CoinStateIdle(), "unused":CoinStateUnused() }
+mushroomStates = { "spawn":MushroomStateSpawn(), "move":MushroomStateMove(), "fall":MushroomStateFall() }
+brickBlockStates = { "idle":BrickBlockStateIdle(), "hitLight":BrickBlockStateHitLight() }#, "hit_hard":BrickBlockStateHitHard() }
+questionBlockStates = { "idle":QuestionBlockStateIdle(), "hit":QuestionBlockStateHit() }
+groundBlockStates = { "idle":GroundBlockStateIdle() }
+pipeStates = { "idle":PipeStateIdle() }
 
 
 ####################################
 # Functions
 ####################################
 
-def collision_sides (a, b):
-    sides = Struct(left=False, right=False, top=False, bottom=False)
-    
-    left = Rect(a.left, a.top + 1, 1, a.height - 2)
-    right = Rect(a.right, a.top + 1, 1, a.height - 2)
-    top = Rect(a.left + 1, a.top, a.w - 2, 1)
-    bottom = Rect(a.left + 1, a.bottom, a.width - 2, 1)
-
-    if left.colliderect(b):
-        sides.left = True
-    if right.colliderect(b):
-        sides.right = True
-    if top.colliderect(b):
-        sides.top = True
-    if bottom.colliderect(b):
-        sides.bottom = True
-
+def contact_sides (a, b):
+    # Which 1px edges of rect a (inset by a pixel at the corners) overlap
+    # rect b, as a bitmask of side flags. Worked out on the coordinates
+    # so the collision pass allocates nothing per contact.
+    sides = 0
+    if a.height > 2 and a.top + 1 < b.bottom and a.bottom - 1 > b.top:
+        if a.left < b.right and a.left + 1 > b.left:
+            sides |= sideLeft
+        if a.right < b.right and a.right + 1 > b.left:
+            sides |= sideRight
+    if a.width > 2 and a.left + 1 < b.right and a.right - 1 > b.left:
+        if a.top < b.bottom and a.top + 1 > b.top:
+            sides |= sideTop
+        if a.bottom < b.bottom and a.bottom + 1 > b.top:
+            sides |= sideBottom
     return sides
 
-def should_fall (entity):
-    for tile in level.map:
-        sides = collision_sides(entity.rect, tile.rect)
-        if sides.bottom:
-            return False
-    return True
-
-def updateFall (entity, deltaTime):
-    landed = False
-    
-    # Check for landing
-    if entity.hasCollision:
-        for tile in entity.collidingObjects:
-            sides = collision_sides(entity.rect, tile.rect)
-            if sides.bottom:
-                # If entity fell on Mario then it's an enemy
-                # and this should trigger death or power-down in Mario.
-                if isinstance(tile, Mario):
-                    return
-                
-                entity.setY(tile.top() - entity.h)
-                entity.changeState("idle")
-                entity.hasCollision = False
-                entity.collidingObjects = []
-                return True 
-    
-    if entity.dy > maxVelocity:
-        entity.dy = maxVelocity
+def contact_depth (a, b):
+    # How far rects a and b overlap along the shallower axis.
+    depthX = min(a.right, b.right) - max(a.left, b.left)
+    depthY = min(a.bottom, b.bottom) - max(a.top, b.top)
+    return min(depthX, depthY)
+
+def sweep_aabb (x, y, w, h, dx, dy, other):
+    # Swept AABB test of box (x, y, w, h) moving by (dx, dy) against the
+    # still box of other. Returns (time, normalX, normalY) for the first
+    # touch, with time in [0, 1] along the move and the normal pointing
+    # out of other, or None when the box misses, only grazes a corner, or
+    # already overlaps other.
+    if dx > 0:
+        entryX = (other.x - (x + w)) / float(dx)
+        exitX = (other.x + other.w - x) / float(dx)
+    elif dx < 0:
+        entryX = (other.x + other.w - x) / float(dx)
+        exitX = (other.x - (x + w)) / float(dx)
+    elif x + w <= other.x or x >= other.x + other.w:
+        return None
     else:
-        entity.dy += entity.velocity
-        
-    entity.velocity += gravity
-    entity.translate(0, entity.dy * deltaTime)
-
-    return landed
-
-def render ():
-    screen.fill(screenBGColor)
-    level.draw()
-    pygame.display.flip()
-
-def tick ():
-    deltaTime = clock.tick(60)
-    level.update(deltaTime)
-    camera.update()
-    
-
-####################################
-# Main loop
-####################################
-
-while running:
-    for event in pygame.event.get():
-        if event.type == QUIT:
-            running = False
-        if event.type == KEYDOWN and event.key == K_ESCAPE:
-            running = False
-
-    tick()
-    render()
-
-    mario = level.getMario()
-    #if not mario is None and mario.isDead:
-    if not mario is None and (mario.y > screenSize[1] or mario.isDead):
-        print "Game Over"
-        running = False
-
-pygame.quit()
-
-
-
-
+        entryX = float("-inf")
+        exitX = float("inf")
+
+    if dy > 0:
+        entryY = (other.y - (y + h)) / float(dy)
+        exitY = (other.y + other.h - y) / float(dy)
+    elif dy < 0:
+        entryY = (other.y + other.h - y) / float(dy)
+        exitY = (other.y - (y + h)) / float(dy)
+    elif y + h <= other.y or y >= other.y + other.h:
+        return None
+    else:
+        entryY = float("-inf")
+        exitY = float("inf")
 
+    entry = max(entryX, entryY)
+    if entry < 0 or entry > 1 or entry >= min(exitX, exitY):
+        return None
+    if entryX > entryY:
+        return entry, (-1 if dx > 0 else 1), 0
+    return entry, 0, (-1 if dy > 0 else 1)
+
+def open_level_source (fileHandle):
+    # Compiled levels are told apart from text ones by their magic. A
+    # source that is already open is passed straight through, so several
+    # Levels can be built from one read of the file; sources are only ever
+    # read from.
+    if isinstance(fileHandle, (TextLevelSource, BinaryLevelSource)):
+        return fileHandle
+    with open(fileHandle, "rb") as f:
+        compiled = f.read(len(levelMagic)) == levelMagic
+    if compiled:
+        return BinaryLevelSource(fileHandle)
+    return TextLevelSource(fileHandle)
+
+def load_world (fileHandle):
+    # A world file lists its levels in the order they are played, one a
+    # line, each optionally followed by the level its pipes lead to. Paths
+    # are relative to the world file; anything after a # is a comment.
+    folder = os.path.dirname(os.path.abspath(fileHandle))
+    levels = []
+    with open(fileHandle) as f:
+        for line in f:
+            names = line.split("#")[0].split()
+            if not names:
+                continue
+            if len(names) > 2:
+                raise ValueError("%s: expected a level and at most one area, got %r" % (fileHandle, line.strip()))
+            paths = [os.path.join(folder, name) for name in names]
+            levels.append((paths[0], paths[1] if len(paths) > 1 else None))
+    if not levels:
+        raise ValueError("%s lists no levels" % fileHandle)
+    return levels
+
+def level_digest (fileHandle):
+    # SHA-1 of a level file, or of a world file and every level it lists,
+    # to tell whether a recording was made on it.
+    handles = [fileHandle]
+    if os.path.splitext(fileHandle)[1] == worldSuffix:
+        handles += [handle for level in load_world(fileHandle) for handle in level if handle is not None]
+    digest = hashlib.sha1()
+    for handle in handles:
+        with open(handle, "rb") as f:
+            digest.update(f.read())
+    return digest.digest()
+
+def open_world (fileHandle, enemyStore=False, stream=False, preloading=True):
+    # A World from a world file, or one of a single level from anything
+    # else open_level_source takes.
+    if isinstance(fileHandle, World):
+        return fileHandle
+    if not isinstance(fileHandle, (TextLevelSource, BinaryLevelSource)) and os.path.splitext(fileHandle)[1] == worldSuffix:
+        return World(load_world(fileHandle), enemyStore, stream, preloading=preloading)
+    return World([(fileHandle, None)], enemyStore, stream, preloading=preloading)
+
+def compile_level (fileHandle, outHandle):
+    # Write the text level fileHandle out in the compiled format.
+    source = TextLevelSource(fileHandle)
+    if source.rows > 0xFF:
+        raise ValueError("%s has %d rows; compiled levels hold at most 255" % (fileHandle, source.rows))
+    chunkColumns = levelChunkColumns
+    offsets = []
+    rects = []
+    for first in range(0, source.columns, chunkColumns):
+        offsets.append(len(rects))
+        for tile, x, y, columns, rows in source.tiles(first, first + chunkColumns):
+            rects.append((tile, x - first, y, columns, rows))
+    offsets.append(len(rects))
+    levelRects = [rect for rect in source.tiles(0, source.columns) if rect[0] in mergedTiles]
+    entities = list(source.entities())
+
+    with open(outHandle, "wb") as f:
+        f.write(levelHeader.pack(levelMagic, levelVersion, source.rows, source.columns, chunkColumns, len(levelRects), len(entities)))
+        f.write(b"".join(levelOffset.pack(offset) for offset in offsets))
+        f.write(b"".join(levelChunkRect.pack(ord(tile), x, y, columns, rows) for tile, x, y, columns, rows in rects))
+        f.write(b"".join(levelRect.pack(ord(tile), x, y, columns, rows) for tile, x, y, columns, rows in levelRects))
+        f.write(b"".join(levelEntity.pack(ord(tile), x, y) for tile, x, y in entities))
+
+def merge_tiles (cells):
+    # (symbol, column, row, columns, rows) rects for (symbol, column, row)
+    # cells. Ground and pipes never change, so each run of them comes out
+    # as a few rects as large as possible instead of one per cell. Far
+    # fewer tiles are left for collisions and updates to walk, and as
+    # merged tiles meet edge to edge there are fewer seams to slide over.
+    # Other tiles come first, one per cell in the order given.
+    merged = {}
+    for tile, x, y in cells:
+        if tile in mergedTiles:
+            merged.setdefault(tile, set()).add((x, y))
+        else:
+            yield tile, x, y, 1, 1
+    for tile in sorted(merged):
+        for x, y, columns, rows in merge_cells(merged[tile]):
+            yield tile, x, y, columns, rows
+
+def merge_cells (cells):
+    # Cover a set of (column, row) cells with (column, row, columns, rows)
+    # rectangles: runs along each row, each stacked onto the same run in
+    # the row above when there is one.
+    rows = {}
+    for x, y in cells:
+        rows.setdefault(y, []).append(x)
+    rects = []
+    above = {}
+    for y in sorted(rows):
+        xs = sorted(rows[y])
+        here = {}
+        start = xs[0]
+        for i, x in enumerate(xs):
+            if i + 1 < len(xs) and xs[i + 1] == x + 1:
+                continue
+            run = (start, x + 1)
+            rect = above.get(run)
+            if rect is not None and rect[1] + rect[3] == y:
+                rect[3] += 1
+            else:
+                rect = [start, y, x + 1 - start, 1]
+                rects.append(rect)
+            here[run] = rect
+            if i + 1 < len(xs):
+                start = xs[i + 1]
+        above = here
+    return rects
+
+def sample_keys (pressed):
+    # Pack the game keys held in pygame.key.get_pressed() into Inputs.
+    mask = 0
+    for key in gameKeys:
+        if pressed[key]:
+            mask |= gameKeyBits[key]
+    return Inputs(mask=mask)
+
+def snapshot_fields (kind):
+    # The names of the fields snapshots save for Entity class kind, and a
+    # getter returning them as a tuple.
+    fields = snapshotFields.get(kind)
+    if fields is None:
+        names = []
+        for cls in reversed(kind.__mro__):
+            for name in cls.__dict__.get("__slots__", ()):
+                if name not in snapshotSkip and name not in names:
+                    names.append(name)
+        fields = (names, operator.attrgetter(*names))
+        snapshotFields[kind] = fields
+    return fields
+
+def capture_entity (entity):
+    return snapshot_fields(type(entity))[1](entity) + (entity.level.contacts.saved(entity),)
+
+def restore_entity (entity, values):
+    names = snapshot_fields(type(entity))[0]
+    for name, value in zip(names, values):
+        setattr(entity, name, value)
+    contacts = entity.level.contacts
+    contacts.clear(entity)
+    for other, sides, depth in values[len(names)]:
+        contacts.add(entity, other, sides, depth)
+    entity.rect = Rect(entity.x, entity.y, entity.w, entity.h)
+    if entity.grid is not None:
+        entity.grid.move(entity)
+
+def letterbox (size, area):
+    # The largest rect of size's shape centered in rect area.
+    scale = min(area.width / float(size[0]), area.height / float(size[1]))
+    rect = Rect(0, 0, int(size[0] * scale), int(size[1] * scale))
+    rect.center = area.center
+    return rect
+
+def parse_size (text):
+    # "256x240" -> [256, 240], for --internal-size.
+    try:
+        w, h = [int(n) for n in text.lower().split("x")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a size like 256x240, got %r" % text)
+    if w <= 0 or h <= 0:
+        raise argparse.ArgumentTypeError("size must be positive, got %r" % text)
+    return [w, h]
+
+def load_order (entity):
+    return entity.loadOrder
+
+def entity_kinds (entity):
+    # The classes an entity is listed under in Level.kinds.
+    for kind in type(entity).__mro__:
+        if kind is Entity:
+            return
+        yield kind
 
+def rect_left (entity):
+    return entity.rect.left
 
+def is_moving_shell (entity):
+    return isinstance(entity, Koopa) and isinstance(entity.currState, KoopaStateShellMove)
 
+def tile_below (entity):
+    # The tile entity stands on, if any. Only tiles touching the strip
+    # just below the entity can hold it up.
+    rect = entity.rect
+    for tile in entity.level.tileGrid.queryArea(rect.left + 1, rect.bottom, rect.right - 1, rect.bottom + 1):
+        if contact_sides(rect, tile.rect) & sideBottom:
+            return tile
+    return None
 
+def should_fall (entity):
+    return tile_below(entity) is None
+
+def fall_distance (entity, deltaTime, fallGravity):
+    # Advance entity.dy and entity.velocity by deltaTime and return how far
+    # the entity falls. Falls are tuned as repeats of one physicsStep update
+    # (dy += velocity, velocity += gravity, move by dy), and this is the
+    # closed form of deltaTime / physicsStep of those, so arcs come out the
+    # same at any physics rate.
+    steps = deltaTime / physicsStep
+    velocity = entity.velocity
+    entity.velocity += fallGravity * steps
+
+    # Terminal velocity
+    if entity.dy > maxVelocity:
+        entity.dy = maxVelocity
+        return entity.dy * deltaTime
 
+    dy = entity.dy
+    entity.dy = dy + velocity * steps + fallGravity * steps * (steps - 1) / 2
+    return physicsStep * (dy * steps + velocity * steps * (steps + 1) / 2 + fallGravity * (steps + 1) * steps * (steps - 1) / 6)
 
+####################################
+# Game
+####################################
 
+# Game
+# Owns the level, camera, screen and clock. A headless game never opens a
+# window or throttles to the clock, so step() can be driven as fast as the
+# simulation runs, e.g. from tests or batch jobs. A windowed game always
+# times its frames with a FrameProfiler; a headless one only with profile.
+# With traceHandle set the Chrome trace is written there on exit. With
+# rewind every physics step is kept in a RewindBuffer. With internalSize
+# the world is drawn into a framebuffer of that size, which is then
+# scaled up to the window: by SDL on the GPU where pygame has the SCALED
+# display mode (the display surface is then the framebuffer), otherwise
+# by a software scale each frame. fileHandle can also be a world file or a
+# World, whose levels are then played in turn. Games that are thrown away
+# after one run can turn preloading off (see World).
+class Game (object):
+    def __init__ (self, fileHandle=levelHandle, headless=False, physicsRate=physicsRate, maxSteps=maxStepsPerFrame, cullMargin=cullMargin, enemyStore=False, stream=False, profile=False, traceHandle=None, rewind=False, internalSize=None, preloading=True):
+        self.headless = headless
+        self.stepTime = 1000.0 / physicsRate
+        self.maxSteps = maxSteps
+        self.accumulator = 0.0
+        self.screen = None
+        self.clock = None
+        self.hardwareScale = False
+        if not headless:
+            pygame.init()
+            if internalSize is not None and hasattr(pygame, "SCALED"):
+                try:
+                    self.screen = pygame.display.set_mode(internalSize, pygame.SCALED | RESIZABLE)
+                    self.hardwareScale = True
+                except pygame.error:
+                    # No renderer for SDL to scale with.
+                    pass
+            if not self.hardwareScale:
+                self.screen = pygame.display.set_mode(screenSize, RESIZABLE)
+            pygame.display.set_caption("SMB")
+            self.clock = pygame.time.Clock()
+        self.world = open_world(fileHandle, enemyStore, stream, preloading)
+        self.cullMargin = cullMargin
+        self.profiler = FrameProfiler() if profile or not headless else None
+        self.showProfiler = False
+        self.traceHandle = traceHandle
+        self.camera = None
+        self.rewind = None
+        self.setLevel(self.world.start())
+        self.frameBuffer = None
+        self.view = None
+        if internalSize is not None:
+            self.setFrameBuffer(internalSize)
+        self.running = True
+        self.gameOver = False
+        self.cleared = False
+        self.frame = 0
+        self.rewind = RewindBuffer(self) if rewind else None
+
+    def setLevel (self, level):
+        # Play level from now on, seen at the same scale. What the rewind
+        # history holds happened in the level left behind, so it starts
+        # over.
+        self.level = level
+        level.cullMargin = self.cullMargin
+        level.profiler = self.profiler
+        scale = self.camera.scale if self.camera is not None else 1.0
+        self.camera = Camera(level)
+        self.camera.scale = scale
+        if self.rewind is not None:
+            self.rewind = RewindBuffer(self, self.rewind.history.maxlen)
+
+    def restart (self):
+        # Start the current level over, from the world's copy of it.
+        self.setLevel(self.world.start(self.world.index))
+
+    def snapshotValues (self):
+        return (self.frame, self.running, self.gameOver)
+
+    def restoreValues (self, values):
+        self.frame, self.running, self.gameOver = values
+
+    def snapshot (self):
+        return self.snapshotValues(), self.level.snapshot()
+
+    def restore (self, snapshot):
+        # Go back to a snapshot of this game. The rewind history is of a
+        # future that no longer happens, so it is dropped.
+        values, levelSnapshot = snapshot
+        self.restoreValues(values)
+        self.level.restore(levelSnapshot)
+        if self.rewind is not None:
+            self.rewind = RewindBuffer(self, self.rewind.history.maxlen)
+
+    def step (self, deltaTime, inputs=noInput):
+        # Advance the simulation by deltaTime milliseconds with the given
+        # keys held. Returns False once the game has ended.
+        self.level.inputs = inputs
+        profiler = self.profiler
+        if profiler is None:
+            self.level.update(deltaTime)
+        else:
+            start = timer()
+            self.level.update(deltaTime)
+            profiler.record("update", start)
+        self.camera.update()
+        self.frame += 1
+
+        exit = self.level.exit
+        if exit is not None:
+            level = self.world.leave(self.level, exit)
+            if level is None:
+                self.cleared = True
+                self.running = False
+            elif level is not self.level:
+                self.setLevel(level)
+
+        mario = self.level.getMario()
+        if not mario is None and (mario.y > screenSize[1] or mario.isDead):
+            self.gameOver = True
+            self.running = False
+        if self.rewind is not None:
+            self.rewind.push()
+        return self.running
+
+    def advance (self, frameTime, inputs=noInput):
+        # Run as many fixed physics steps as frameTime milliseconds cover,
+        # carrying the remainder over to the next frame. When rendering
+        # falls too far behind, drop the backlog past maxSteps rather than
+        # trying to catch up with ever longer frames.
+        self.accumulator += frameTime
+        steps = 0
+        while self.running and self.accumulator >= self.stepTime:
+            if steps == self.maxSteps:
+                self.accumulator %= self.stepTime
+                break
+            self.step(self.stepTime, inputs)
+            self.accumulator -= self.stepTime
+            steps += 1
+        return self.running
+
+    def setFrameBuffer (self, size):
+        # Draw into a size framebuffer from now on. The view covers the
+        # same part of the world as ever, fitted inside it at one scale
+        # so nothing is stretched; any space left over stays black.
+        if self.hardwareScale:
+            self.frameBuffer = self.screen
+        else:
+            self.frameBuffer = pygame.Surface(size)
+        self.frameBuffer.fill(black)
+        area = letterbox(screenSize, self.frameBuffer.get_rect())
+        self.view = self.frameBuffer.subsurface(area)
+        self.camera.scale = area.width / float(screenSize[0])
+
+    def render (self):
+        # Draw straight to the window while it is the size of the view.
+        # Otherwise draw into the framebuffer (made at the view size if the
+        # window was only resized) and, unless SDL scales the display
+        # itself, scale that to the window in one pass, letterboxed to
+        # keep its shape.
+        profiler = self.profiler
+        start = timer()
+        self.camera.interpolate(self.accumulator / self.stepTime)
+        window = self.screen
+        if self.frameBuffer is None and window.get_size() != tuple(screenSize):
+            self.setFrameBuffer(screenSize)
+        if self.frameBuffer is None:
+            window.fill(screenBGColor)
+            self.level.draw(window, self.camera)
+        else:
+            self.view.fill(screenBGColor)
+            self.level.draw(self.view, self.camera)
+        if self.frameBuffer is not None and not self.hardwareScale:
+            area = letterbox(self.frameBuffer.get_size(), window.get_rect())
+            if area.size != window.get_size():
+                window.fill(black)
+            pygame.transform.scale(self.frameBuffer, area.size, window.subsurface(area))
+        profiler.record("draw", start)
+        if self.showProfiler:
+            profiler.draw(self.screen)
+        start = timer()
+        pygame.display.flip()
+        profiler.record("flip", start)
+
+    def exportTrace (self):
+        self.profiler.exportTrace(self.traceHandle or profilerTraceHandle)
+
+    def run (self, recorder=None, replay=None):
+        # Play until the game ends or the window is closed. Each frame's
+        # keys are sampled once, up front. With an InputRecorder the frames
+        # are written out; with an InputReplay its frames are played back
+        # in place of the keyboard and clock, ending with the recording.
+        # Holding rewindKey steps back instead, when there is a rewind
+        # buffer.
+        frames = iter(replay.frames) if replay is not None else None
+        profiler = self.profiler
+        while self.running:
+            start = timer()
+            for event in pygame.event.get():
+                if event.type == QUIT:
+                    self.running = False
+                if event.type == KEYDOWN and event.key == K_ESCAPE:
+                    self.running = False
+                if event.type == VIDEORESIZE and not self.hardwareScale:
+                    self.screen = pygame.display.set_mode(event.size, RESIZABLE)
+                if event.type == KEYDOWN and event.key == profilerKey:
+                    self.showProfiler = not self.showProfiler
+                if event.type == KEYDOWN and event.key == profilerTraceKey:
+                    self.exportTrace()
+                if event.type == KEYDOWN and event.key == restartKey and frames is None and recorder is None:
+                    self.restart()
+            profiler.record("events", start)
+
+            start = timer()
+            frameTime = self.clock.tick(60)
+            profiler.record("tick", start)
+            if frames is not None:
+                frameTime, inputs = next(frames, (None, None))
+                if inputs is None:
+                    break
+            else:
+                pressed = pygame.key.get_pressed()
+                inputs = sample_keys(pressed)
+                if self.rewind is not None and pressed[rewindKey]:
+                    self.rewind.rewind()
+                    self.accumulator = 0.0
+                    self.render()
+                    profiler.endFrame()
+                    continue
+            if recorder is not None:
+                recorder.write(frameTime, inputs)
+            self.advance(frameTime, inputs)
+            self.render()
+            profiler.endFrame()
+
+        if recorder is not None:
+            recorder.close()
+        if self.traceHandle is not None:
+            self.exportTrace()
+        if self.gameOver:
+            print("Game Over")
+        elif self.cleared:
+            print("World Clear")
+        pygame.quit()
 
 
+####################################
+# Main
+####################################
 
+def main (argv=None):
+    parser = argparse.ArgumentParser(description="Super Mario Bros in Pygame.")
+    parser.add_argument("level", nargs="?", default=levelHandle, help="level file, or %s file of levels, to play" % worldSuffix)
+    parser.add_argument("--headless", action="store_true", help="simulate without a window or frame throttling")
+    parser.add_argument("--frames", type=int, default=600, help="frames to simulate when headless")
+    parser.add_argument("--physics-rate", type=float, default=physicsRate, help="physics steps per second")
+    parser.add_argument("--max-steps", type=int, default=maxStepsPerFrame, help="most physics steps run per rendered frame")
+    parser.add_argument("--enemy-store", action="store_true", help="keep enemies in NumPy arrays and move them in batches")
+    parser.add_argument("--stream", action="store_true", help="build the level in chunks around the view")
+    parser.add_argument("--compile", metavar="OUT", help="compile the text level to OUT and exit")
+    parser.add_argument("--record", metavar="FILE", help="record the keys of every frame to FILE")
+    parser.add_argument("--replay", metavar="FILE", help="play back keys recorded with --record")
+    parser.add_argument("--internal-size", type=parse_size, metavar="WxH", help="draw into a WxH framebuffer (e.g. 256x240) and scale it up to the window")
+    parser.add_argument("--no-rewind", action="store_true", help="don't keep the history that holding R rewinds through")
+    parser.add_argument("--profile", action="store_true", help="show the frame profiler overlay from the start (toggle with F3)")
+    parser.add_argument("--trace", metavar="FILE", help="write a Chrome trace of the last frames to FILE on exit (F4 writes it any time)")
+    args = parser.parse_args(argv)
+
+    if args.compile:
+        compile_level(args.level, args.compile)
+        return
 
+    if args.record and args.headless:
+        parser.error("--record needs the window: headless runs have no keys to record")
+
+    replay = None
+    if args.replay:
+        replay = InputReplay(args.replay)
+        try:
+            replay.check(args.level, args.enemy_store, args.stream)
+        except ValueError as e:
+            parser.error(str(e))
+        args.physics_rate = replay.physicsRate
+        args.max_steps = replay.maxSteps
+
+    if not args.headless:
+        recorder = None
+        if args.record:
+            recorder = InputRecorder(args.record, args.physics_rate, args.max_steps, level_digest(args.level), args.enemy_store, args.stream)
+        # Rewinding needs snapshots, and would throw recordings and replays
+        # out of step with the keys.
+        rewind = not (args.no_rewind or args.enemy_store or args.stream or args.record or replay)
+        game = Game(args.level, physicsRate=args.physics_rate, maxSteps=args.max_steps, enemyStore=args.enemy_store, stream=args.stream, traceHandle=args.trace, rewind=rewind, internalSize=args.internal_size)
+        game.showProfiler = args.profile
+        game.run(recorder, replay)
+        return
 
+    if replay is not None:
+        # Play the recorded frames back as fast as they simulate.
+        game = Game(args.level, headless=True, physicsRate=args.physics_rate, maxSteps=args.max_steps, enemyStore=args.enemy_store, stream=args.stream, profile=args.profile or bool(args.trace), traceHandle=args.trace)
+        start = timer()
+        for frameTime, inputs in replay.frames:
+            running = game.advance(frameTime, inputs)
+            if game.profiler is not None:
+                game.profiler.endFrame()
+            if not running:
+                break
+        elapsed = max(timer() - start, 1e-9)
+        mario = game.level.getMario()
+        print("%d frames, %d steps in %.3fs; Mario at (%r, %r)%s" % (len(replay.frames), game.frame, elapsed, mario.x, mario.y, ", game over" if game.gameOver else ""))
+        report_profile(game)
+        return
 
+    game = Game(args.level, headless=True, physicsRate=args.physics_rate, enemyStore=args.enemy_store, stream=args.stream, profile=args.profile or bool(args.trace), traceHandle=args.trace)
+    start = timer()
+    while game.frame < args.frames and game.step(game.stepTime):
+        if game.profiler is not None:
+            game.profiler.endFrame()
+    elapsed = max(timer() - start, 1e-9)
+    print("%d frames in %.3fs (%.0f fps)" % (game.frame, elapsed, game.frame / elapsed))
+    report_profile(game)
+
+def report_profile (game):
+    # Headless runs print the profiler's percentiles instead of an overlay.
+    if game.profiler is None:
+        return
+    print("\n".join(game.profiler.summary()))
+    if game.traceHandle is not None:
+        game.exportTrace()
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import pygame
+from pygame.locals import *
+
+import SMB
+import generate
+
+# Plays scripted input through generated levels of growing length and
+# times update, collision and draw per frame, then writes the results as
+# JSON so runs can be compared over time. Drawing goes to an off-screen
+# surface, so no window is needed.
+
+####################################
+# Constants
+####################################
+
+defaultColumns = [200, 1000, 5000]
+defaultFrames = 600
+
+####################################
+# Functions
+####################################
+
+def scripted_inputs (frame):
+    # Run right most of the time, with a jump every second and a half and
+    # the run key held half of the time.
+    keys = []
+    if (frame // 200) % 4 != 3:
+        keys.append(K_d)
+    if frame % 90 < 20:
+        keys.append(K_SPACE)
+    if frame % 500 < 250:
+        keys.append(K_LSHIFT)
+    return SMB.Inputs(keys)
+
+def keep_playing (game):
+    # Keep Mario in play so every level gets the full run: a hit is
+    # ignored, and a fall through a gap drops him back in from the top.
+    mario = game.level.getMario()
+    mario.isDead = False
+    if mario.y > game.level.height:
+        mario.setY(0)
+        mario.changeState("fall")
+
+def play (levelHandle, frames, draw, options):
+    # Play frames physics steps of the level, each followed by a draw when
+    # draw is set. Returns the seconds spent in updates, collision checks
+    # and draws, and how many tiles and entities ended up loaded.
+    game = SMB.Game(levelHandle, headless=True, preloading=False, **options)
+    level = game.level
+    screen = pygame.Surface(SMB.screenSize) if draw else None
+    timings = {"update": 0.0, "collision": 0.0, "draw": 0.0}
+
+    # Time collision checks apart from the rest of Level.update.
+    checkCollisions = level.checkCollisions
+    def timedCheckCollisions ():
+        start = SMB.timer()
+        checkCollisions()
+        timings["collision"] += SMB.timer() - start
+    level.checkCollisions = timedCheckCollisions
+
+    for frame in range(frames):
+        inputs = scripted_inputs(frame)
+        start = SMB.timer()
+        level.inputs = inputs
+        level.update(game.stepTime)
+        game.camera.update()
+        timings["update"] += SMB.timer() - start
+        keep_playing(game)
+
+        if draw:
+            start = SMB.timer()
+            game.camera.interpolate(1.0)
+            screen.fill(SMB.screenBGColor)
+            level.draw(screen, game.camera)
+            timings["draw"] += SMB.timer() - start
+
+    timings["update"] -= timings["collision"]
+    return timings, len(level.map), len(level.entities)
+
+def peak_memory (levelHandle, frames, draw, options):
+    # A second, traced run, so tracing doesn't slow the timed one.
+    tracemalloc.start()
+    play(levelHandle, frames, draw, options)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def run_benchmark (columns, frames, draw, levelOptions, options):
+    levelHandle = os.path.join(tempfile.mkdtemp(), "level-%d.txt" % columns)
+    generate.write_level(levelHandle, generate.generate_level(columns, **levelOptions))
+    timings, tiles, entities = play(levelHandle, frames, draw, options)
+    peak = peak_memory(levelHandle, frames, draw, options)
+    os.remove(levelHandle)
+    os.rmdir(os.path.dirname(levelHandle))
+
+    total = sum(timings.values())
+    result = {
+        "columns": columns,
+        "frames": frames,
+        "tiles": tiles,
+        "entities": entities,
+        "fps": frames / max(total, 1e-9),
+        "peakMemoryBytes": peak,
+    }
+    for name, seconds in timings.items():
+        result[name + "Ms"] = 1000.0 * seconds / frames
+    return result
+
+####################################
+# Main
+####################################
+
+def main (argv=None):
+    parser = argparse.ArgumentParser(description="Time Level.update, checkCollisions and draw on generated levels.")
+    parser.add_argument("--columns", type=int, nargs="+", default=defaultColumns, help="level lengths to run, in tiles")
+    parser.add_argument("--frames", type=int, default=defaultFrames, help="frames to play on each level")
+    parser.add_argument("--enemies", type=float, default=0.05, help="chance of an enemy in each column")
+    parser.add_argument("--blocks", type=float, default=0.05, help="chance of a block in each column of each block row")
+    parser.add_argument("--pipes-per-100", type=float, default=1, help="pipes per 100 columns")
+    parser.add_argument("--gaps", type=float, default=0.02, help="chance of a gap starting in each column")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the levels")
+    parser.add_argument("--no-draw", action="store_true", help="skip drawing")
+    parser.add_argument("--stream", action="store_true", help="stream the levels in chunks")
+    parser.add_argument("--enemy-store", action="store_true", help="use the NumPy enemy store")
+    parser.add_argument("--out", default="benchmark.json", help="JSON file to write the results to")
+    args = parser.parse_args(argv)
+
+    options = {"stream": args.stream, "enemyStore": args.enemy_store}
+    results = []
+    for columns in args.columns:
+        levelOptions = {
+            "enemyDensity": args.enemies,
+            "blockDensity": args.blocks,
+            "pipes": int(columns * args.pipes_per_100 / 100),
+            "gapDensity": args.gaps,
+            "seed": args.seed,
+        }
+        result = run_benchmark(columns, args.frames, not args.no_draw, levelOptions, options)
+        results.append(result)
+        print("%6d columns: %7.0f fps  update %.3f ms  collision %.3f ms  draw %.3f ms  peak %.1f MB" % (
+            columns, result["fps"], result["updateMs"], result["collisionMs"], result["drawMs"], result["peakMemoryBytes"] / 1e6))
+
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pygame": pygame.version.ver,
+        "options": dict(options, enemies=args.enemies, blocks=args.blocks, pipesPer100=args.pipes_per_100,
+                        gaps=args.gaps, seed=args.seed, draw=not args.no_draw),
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import argparse
+import multiprocessing
+import random
+import time
+
+import SMB
+
+# Runs many independent copies of a level side by side, spread over worker
+# processes, for automated playtests, level QA and training agents. Each
+# copy is a headless Game driven one action at a time; an action is the
+# key mask of an SMB.Inputs (see SMB.gameKeys). Every worker reads the
+# level once and builds fresh Levels from that copy whenever a game is
+# reset, so resets never go back to disk.
+
+####################################
+# Constants
+####################################
+
+# Reward is the distance Mario moved right in tiles, and deathReward on
+# the step he dies or falls out of the level.
+deathReward = -10.0
+marioStateNames = dict((state, name) for name, state in SMB.marioStates.items())
+observationFields = ["x", "y", "state", "alive", "reward"]
+
+####################################
+# Classes
+####################################
+
+# BatchEnv
+# count games of one level run in up to workers processes (by default one
+# per CPU). step() takes a batch of count actions and returns observations
+# as a dict of count-long lists, one for each of observationFields. A game
+# that ends reports alive False for that step and, with autoReset, starts
+# over on the next one.
+class BatchEnv (object):
+    def __init__ (self, fileHandle=SMB.levelHandle, count=8, workers=None, stepsPerAction=1, autoReset=True, enemyStore=False):
+        self.count = count
+        workers = min(workers or multiprocessing.cpu_count(), count)
+        options = { "stepsPerAction":stepsPerAction, "autoReset":autoReset, "enemyStore":enemyStore }
+        self.slices = []
+        self.connections = []
+        self.processes = []
+        for i in range(workers):
+            first, last = count * i // workers, count * (i + 1) // workers
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=run_worker, args=(child, fileHandle, last - first, options))
+            process.daemon = True
+            process.start()
+            child.close()
+            self.slices.append((first, last))
+            self.connections.append(parent)
+            self.processes.append(process)
+
+    def gather (self):
+        observations = dict((field, []) for field in observationFields)
+        for connection in self.connections:
+            result = connection.recv()
+            for field in observationFields:
+                observations[field].extend(result[field])
+        return observations
+
+    def reset (self):
+        for connection in self.connections:
+            connection.send(("reset", None))
+        return self.gather()
+
+    def step (self, actions):
+        if len(actions) != self.count:
+            raise ValueError("expected %d actions, got %d" % (self.count, len(actions)))
+        # Send every worker its share before waiting on any of them, so the
+        # workers all step at once.
+        for (first, last), connection in zip(self.slices, self.connections):
+            connection.send(("step", list(actions[first:last])))
+        return self.gather()
+
+    def close (self):
+        for connection in self.connections:
+            connection.send(("close", None))
+            connection.close()
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
+
+# Worker
+# The games of one worker process. The level source is opened once and
+# shared by every Level the worker builds.
+class Worker (object):
+    def __init__ (self, fileHandle, count, stepsPerAction=1, autoReset=True, enemyStore=False):
+        self.source = SMB.open_level_source(fileHandle)
+        self.stepsPerAction = stepsPerAction
+        self.autoReset = autoReset
+        self.enemyStore = enemyStore
+        self.games = [None] * count
+        self.reset()
+
+    def newGame (self):
+        return SMB.Game(self.source, headless=True, enemyStore=self.enemyStore, preloading=False)
+
+    def reset (self):
+        self.games = [self.newGame() for game in self.games]
+        self.prevX = [game.level.getMario().x for game in self.games]
+        return self.observe([0.0] * len(self.games))
+
+    def step (self, actions):
+        rewards = []
+        for i, action in enumerate(actions):
+            game = self.games[i]
+            if game.running:
+                inputs = SMB.Inputs(mask=action)
+                for n in range(self.stepsPerAction):
+                    if not game.step(game.stepTime, inputs):
+                        break
+                x = game.level.getMario().x
+                rewards.append(deathReward if game.gameOver else (x - self.prevX[i]) / float(SMB.tileWidth))
+                self.prevX[i] = x
+            else:
+                rewards.append(0.0)
+        observations = self.observe(rewards)
+        if self.autoReset:
+            for i, game in enumerate(self.games):
+                if not game.running:
+                    self.games[i] = self.newGame()
+                    self.prevX[i] = self.games[i].level.getMario().x
+        return observations
+
+    def observe (self, rewards):
+        observations = dict((field, []) for field in observationFields)
+        for game in self.games:
+            mario = game.level.getMario()
+            observations["x"].append(mario.x)
+            observations["y"].append(mario.y)
+            observations["state"].append(marioStateNames.get(mario.currState))
+            observations["alive"].append(game.running)
+        observations["reward"] = rewards
+        return observations
+
+####################################
+# Functions
+####################################
+
+def run_worker (connection, fileHandle, count, options):
+    worker = Worker(fileHandle, count, **options)
+    while True:
+        command, data = connection.recv()
+        if command == "step":
+            connection.send(worker.step(data))
+        elif command == "reset":
+            connection.send(worker.reset())
+        elif command == "close":
+            break
+    connection.close()
+
+def random_action (rng):
+    # Mostly running right, jumping now and then.
+    keys = [SMB.K_d]
+    if rng.random() < 0.3:
+        keys.append(SMB.K_SPACE)
+    if rng.random() < 0.5:
+        keys.append(SMB.K_LSHIFT)
+    if rng.random() < 0.1:
+        keys = [SMB.K_a]
+    return SMB.Inputs(keys).mask
+
+####################################
+# Main
+####################################
+
+def main (argv=None):
+    parser = argparse.ArgumentParser(description="Run copies of a level in parallel with random actions and report throughput.")
+    parser.add_argument("level", nargs="?", default=SMB.levelHandle, help="level file to play")
+    parser.add_argument("--count", type=int, default=16, help="games to run side by side")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per CPU)")
+    parser.add_argument("--steps", type=int, default=1000, help="batched steps to run")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the actions")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    env = BatchEnv(args.level, args.count, args.workers)
+    env.reset()
+    start = time.time()
+    deaths = 0
+    for n in range(args.steps):
+        observations = env.step([random_action(rng) for i in range(args.count)])
+        deaths += observations["alive"].count(False)
+    elapsed = max(time.time() - start, 1e-9)
+    env.close()
+    print("%d games x %d steps in %.3fs (%.0f game steps/s, %d deaths)" % (args.count, args.steps, elapsed, args.count * args.steps / elapsed, deaths))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import argparse
+import random
+
+import SMB
+
+# Writes synthetic levels in the same text format as 1-1.txt, laid out the
+# same way: two rows of ground with the odd gap, pipes standing on it, rows
+# of bricks and question blocks above, and enemies along the ground.
+# Levels come out the same for the same arguments and seed.
+
+####################################
+# Constants
+####################################
+
+levelRows = 15
+groundRow = 13
+walkRow = groundRow - 1
+lowBlockRow = 9
+highBlockRow = 5
+safeColumns = 16
+pipeWidth = 3
+blockTiles = [SMB.blockTile] * 3 + [SMB.qCoinTile, SMB.qMushTile]
+
+####################################
+# Functions
+####################################
+
+def generate_level (columns, enemyDensity=0.05, blockDensity=0.05, pipes=10, gapDensity=0.02, seed=0):
+    # Rows of a level columns tiles wide. Densities are the chance of each
+    # free column getting an enemy, a block in each block row, or a
+    # two-wide gap in the ground. The first safeColumns columns are kept
+    # clear for Mario to start on.
+    rng = random.Random(seed)
+    rows = [[SMB.blankTile] * columns for i in range(levelRows)]
+    for x in range(columns):
+        rows[groundRow][x] = SMB.groundTile
+        rows[groundRow + 1][x] = SMB.groundTile
+    rows[walkRow][3] = SMB.marioTile
+
+    # Pipes, spread evenly over the level, each two to four tiles high.
+    taken = set()
+    if pipes > 0 and columns > safeColumns + pipeWidth:
+        spacing = (columns - safeColumns - pipeWidth) / float(pipes)
+        for i in range(pipes):
+            left = safeColumns + int(i * spacing + rng.random() * max(spacing - pipeWidth, 0))
+            height = rng.randint(2, 4)
+            for x in range(left, min(left + pipeWidth, columns)):
+                taken.add(x)
+                for y in range(walkRow - height + 1, walkRow + 1):
+                    rows[y][x] = SMB.pipeTile
+
+    # Gaps, never under a pipe or at the very end.
+    x = safeColumns
+    while x < columns - safeColumns:
+        if x not in taken and x + 1 not in taken and rng.random() < gapDensity:
+            for gap in (x, x + 1):
+                rows[groundRow][gap] = SMB.blankTile
+                rows[groundRow + 1][gap] = SMB.blankTile
+                taken.add(gap)
+            x += 2
+        x += 1
+
+    for x in range(safeColumns, columns):
+        for y in (lowBlockRow, highBlockRow):
+            if rng.random() < blockDensity:
+                rows[y][x] = rng.choice(blockTiles)
+        if x not in taken and rng.random() < enemyDensity:
+            rows[walkRow][x] = SMB.koopaTile if rng.random() < 0.25 else SMB.goombaTile
+
+    return ["".join(row).rstrip() for row in rows]
+
+def write_level (fileHandle, rows):
+    with open(fileHandle, "w") as f:
+        f.write("\n".join(rows))
+
+####################################
+# Main
+####################################
+
+def main (argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic level in the 1-1.txt format.")
+    parser.add_argument("out", help="level file to write")
+    parser.add_argument("--columns", type=int, default=1000, help="level length in tiles")
+    parser.add_argument("--enemies", type=float, default=0.05, help="chance of an enemy in each column")
+    parser.add_argument("--blocks", type=float, default=0.05, help="chance of a block in each column of each block row")
+    parser.add_argument("--pipes", type=int, default=10, help="number of pipes")
+    parser.add_argument("--gaps", type=float, default=0.02, help="chance of a gap starting in each column")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args(argv)
+
+    write_level(args.out, generate_level(args.columns, args.enemies, args.blocks, args.pipes, args.gaps, args.seed))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Levels are laid out as 1-1 is: the ground takes the two rows from
+# groundRow down.
+groundRow = 13
+
+@pytest.fixture
+def level_file (tmp_path):
+    # Writes the given rows as a text level named name and returns its
+    # path. Rows are padded out to groundRow rows, and two rows of ground
+    # are added under them when ground is set.
+    def write (rows, ground=True, name="level.txt"):
+        rows = list(rows)
+        while len(rows) < groundRow:
+            rows.insert(0, "")
+        if ground:
+            width = max(len(row) for row in rows)
+            rows += ["g" * width, "g" * width]
+        path = str(tmp_path / name)
+        with open(path, "w") as f:
+            f.write("\n".join(rows))
+        return path
+    return write
@@ -0,0 +1,27 @@
+import os
+
+import SMB
+
+def tiles (level):
+    return [(type(tile), tile.x, tile.y, tile.w, tile.h, tile.loadOrder) for tile in level.map]
+
+def compile_one_one (tmp_path):
+    compiled = str(tmp_path / "1-1.smbl")
+    SMB.compile_level(SMB.levelHandle, compiled)
+    return compiled
+
+def test_compiled_level_loads_like_text (tmp_path):
+    compiled = compile_one_one(tmp_path)
+    assert os.path.getsize(compiled) < os.path.getsize(SMB.levelHandle)
+    text, level = SMB.Level(SMB.levelHandle), SMB.Level(compiled)
+    assert tiles(level) == tiles(text)
+    assert level.spawnQueue == text.spawnQueue
+    level.source.close()
+
+def test_compiled_ranges_match_text (tmp_path):
+    textSource = SMB.open_level_source(SMB.levelHandle)
+    source = SMB.open_level_source(compile_one_one(tmp_path))
+    # A chunk, a range across chunks and one running past the end.
+    for first, last in [(32, 48), (5, 40), (200, 300)]:
+        assert list(source.tiles(first, last)) == list(textSource.tiles(first, last))
+    source.close()
@@ -0,0 +1,107 @@
+import SMB
+
+stepTime = 1000.0 / 60
+
+def test_mushroom_leaves_block_where_it_rose (level_file):
+    # Nothing but the block and the ground to touch, so the mushroom
+    # should rise out of the block and walk on from where it came out.
+    game = SMB.Game(level_file([" 1", "", "", "m"]), headless=True)
+    level = game.level
+    block = [tile for tile in level.map if isinstance(tile, SMB.QuestionBlock)][0]
+    mushroom = [entity for entity in level.entities if isinstance(entity, SMB.Mushroom)][0]
+    move = mushroom.allStates["move"]
+    block.changeState("hit")
+    for i in range(200):
+        game.step(stepTime)
+        if mushroom.currState is move:
+            break
+    assert mushroom.currState is move
+    assert mushroom.x == block.x
+
+    x = mushroom.x
+    game.step(stepTime)
+    assert 0 < mushroom.x - x <= 0.15 * stepTime + 1
+
+class Thing (object):
+    # Just enough of an entity for a ContactBuffer.
+    contactKind = 0
+
+    def __init__ (self):
+        self.contactHead = -1
+        self.contactTail = -1
+
+def test_buffer_grows_and_reuses_cleared_slots ():
+    contacts = SMB.ContactBuffer(2)
+    entity = Thing()
+    others = [Thing() for i in range(5)]
+    for i, other in enumerate(others):
+        contacts.add(entity, other, i, 0)
+    assert len(contacts.others) == 8
+    assert [found[0] for found in contacts.saved(entity)] == others
+
+    contacts.clear(entity)
+    assert contacts.saved(entity) == ()
+    for other in others:
+        contacts.add(entity, other, 0, 0)
+    assert len(contacts.others) == 8
+    assert [found[0] for found in contacts.saved(entity)] == others
+
+def test_dispatch_stops_on_true_or_cleared ():
+    contacts = SMB.ContactBuffer(8)
+    entity = Thing()
+    for i in range(3):
+        contacts.add(entity, Thing(), i, 0)
+    seen = []
+
+    def stopAt (entity, other, sides):
+        seen.append(sides)
+        return sides == 1
+
+    assert contacts.dispatch(entity, [[stopAt]]) is True
+    assert seen == [0, 1]
+    assert len(contacts.saved(entity)) == 3
+
+    # Clearing hands the slots back to the free list, which the walk
+    # must not follow.
+    def clearAll (entity, other, sides):
+        seen.append(sides)
+        contacts.clear(entity)
+
+    del seen[:]
+    assert contacts.dispatch(entity, [[clearAll]]) is None
+    assert seen == [0]
+
+def test_jump_bumps_head_then_lands (level_file):
+    game = SMB.Game(level_file([" ggg", "", "", "  m"]), headless=True)
+    level = game.level
+    mario = level.getMario()
+    block = [tile for tile in level.map if tile.y < mario.y][0]
+    ground = mario.y
+    mario.changeState("jump")
+    top = mario.y
+    for i in range(120):
+        game.step(stepTime)
+        top = min(top, mario.y)
+        if mario.currState is mario.allStates["idle"]:
+            break
+    assert top == block.bottom()
+    assert mario.currState is mario.allStates["idle"]
+    assert mario.y == ground
+
+def test_shell_knocks_out_enemy (level_file):
+    game = SMB.Game(level_file([" m    #     @"]), headless=True)
+    level = game.level
+    game.step(stepTime)
+    koopa = [entity for entity in level.entities if isinstance(entity, SMB.Koopa)][0]
+    goomba = [entity for entity in level.entities if isinstance(entity, SMB.Goomba)][0]
+    knocked = goomba.allStates["knocked"]
+    koopa.changeState("stomped")
+    koopa.isDead = False
+    koopa.direction = "right"
+    koopa.changeState("shellMove")
+    for i in range(200):
+        level.getMario().isDead = False
+        game.step(stepTime)
+        if goomba.currState is knocked:
+            break
+    assert goomba.currState is knocked
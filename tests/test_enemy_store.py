@@ -0,0 +1,54 @@
+import pytest
+
+import SMB
+
+pytest.importorskip("numpy")
+
+def stored_game (level_file, row):
+    game = SMB.Game(level_file([row]), headless=True, enemyStore=True)
+    game.step(game.stepTime)
+    return game
+
+def entities_of (level, kind):
+    return [entity for entity in level.entities if isinstance(entity, kind)]
+
+def play (game, steps):
+    # Keep stepping whatever happens to Mario.
+    for i in range(steps):
+        game.level.getMario().isDead = False
+        game.step(game.stepTime)
+
+def test_stomped_goomba_is_released_for_good (level_file):
+    game = stored_game(level_file, " m      @")
+    level = game.level
+    goomba = entities_of(level, SMB.Goomba)[0]
+    mario = level.getMario()
+    mario.setX(goomba.x)
+    mario.setY(goomba.y - mario.h - 5)
+    mario.changeState("fall")
+    play(game, 10)
+    assert goomba.isDead
+
+    # Squashed for a second, then removed; the row must stay released
+    # and never be moved again.
+    play(game, 120)
+    assert goomba not in level.entities
+    assert level.enemyStore.state[goomba.row] == -1
+    x = goomba.x
+    play(game, 120)
+    assert level.enemyStore.state[goomba.row] == -1
+    assert goomba.x == x
+
+def test_enemy_knocked_by_shell_is_removed (level_file):
+    game = stored_game(level_file, " m    #     @")
+    level = game.level
+    koopa = entities_of(level, SMB.Koopa)[0]
+    goomba = entities_of(level, SMB.Goomba)[0]
+    koopa.changeState("stomped")
+    koopa.isDead = False
+    koopa.direction = "right"
+    koopa.changeState("shellMove")
+    play(game, 200)
+    assert goomba.isDeadDead
+    assert goomba not in level.entities
+    assert level.enemyStore.state[goomba.row] == -1
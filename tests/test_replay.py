@@ -0,0 +1,87 @@
+import pytest
+
+import SMB
+
+def scripted_inputs (frame):
+    # Run right with a jump every second or so, as benchmark.py does.
+    keys = [SMB.K_d]
+    if frame % 70 < 20:
+        keys.append(SMB.K_SPACE)
+    if frame % 300 < 150:
+        keys.append(SMB.K_LSHIFT)
+    return SMB.Inputs(keys)
+
+def state (game):
+    # Where everything is and what it is doing, comparable across games.
+    level = game.level
+    objects = level.entities + level.map
+    return (game.frame, game.running, level.stepCount,
+            [(type(obj).__name__, obj.x, obj.y, type(getattr(obj, "currState", None)).__name__) for obj in objects])
+
+def play (game, first, steps):
+    states = []
+    for frame in range(first, first + steps):
+        game.step(game.stepTime, scripted_inputs(frame))
+        states.append(state(game))
+    return states
+
+def test_restored_snapshot_plays_out_the_same ():
+    game = SMB.Game(headless=True)
+    play(game, 0, 150)
+    snapshot = game.snapshot()
+    before = state(game)
+    after = play(game, 150, 200)
+    game.restore(snapshot)
+    assert state(game) == before
+    assert play(game, 150, 200) == after
+
+def test_rewind_retraces_its_steps ():
+    game = SMB.Game(headless=True, rewind=True)
+    states = [state(game)] + play(game, 0, 300)
+    for back in range(1, 120):
+        assert game.rewind.rewind()
+        assert state(game) == states[-1 - back]
+    # Played forward again from there, it comes out the same.
+    assert play(game, 300 - 119, 119) == states[-119:]
+
+def test_replay_matches_recording (tmp_path):
+    path = str(tmp_path / "inputs.rec")
+    # Uneven frame times, including a long one that hits maxSteps.
+    frameTimes = [16, 17, 33, 5, 120, 16]
+    game = SMB.Game(headless=True)
+    recorder = SMB.InputRecorder(path, SMB.physicsRate, game.maxSteps, SMB.level_digest(SMB.levelHandle))
+    recorded = []
+    for frame in range(400):
+        frameTime = frameTimes[frame % len(frameTimes)]
+        inputs = scripted_inputs(frame)
+        recorder.write(frameTime, inputs)
+        game.advance(frameTime, inputs)
+        recorded.append(state(game))
+    recorder.close()
+
+    replay = SMB.InputReplay(path)
+    replay.check(SMB.levelHandle, False, False)
+    game = SMB.Game(headless=True, physicsRate=replay.physicsRate, maxSteps=replay.maxSteps)
+    replayed = []
+    for frameTime, inputs in replay.frames:
+        game.advance(frameTime, inputs)
+        replayed.append(state(game))
+    assert replayed == recorded
+
+def test_replay_refuses_other_level_or_options (tmp_path, level_file):
+    path = str(tmp_path / "inputs.rec")
+    recorder = SMB.InputRecorder(path, SMB.physicsRate, SMB.maxStepsPerFrame, SMB.level_digest(SMB.levelHandle), stream=True)
+    recorder.write(16, SMB.noInput)
+    recorder.close()
+    replay = SMB.InputReplay(path)
+    replay.check(SMB.levelHandle, False, True)
+    with pytest.raises(ValueError):
+        replay.check(level_file(["m"]), False, True)
+    with pytest.raises(ValueError):
+        replay.check(SMB.levelHandle, False, False)
+    with pytest.raises(SystemExit):
+        SMB.main([level_file(["m"]), "--headless", "--stream", "--replay", path])
+
+def test_headless_record_is_refused (tmp_path):
+    with pytest.raises(SystemExit):
+        SMB.main(["--headless", "--record", str(tmp_path / "inputs.rec")])
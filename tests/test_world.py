@@ -0,0 +1,40 @@
+import threading
+
+import SMB
+
+def make_world (level_file, count, preloading=True):
+    levels = []
+    for i in range(count):
+        path = level_file(["m".ljust(20)], name="level%d.txt" % i)
+        levels.append((path, None))
+    world = SMB.World(levels, preloading=preloading)
+    # Note which threads levels are built on.
+    world.builtOn = []
+    build = world.build
+    def recordedBuild (fileHandle):
+        world.builtOn.append(threading.current_thread())
+        return build(fileHandle)
+    world.build = recordedBuild
+    return world
+
+def test_restart_is_a_swap (level_file):
+    world = make_world(level_file, 2)
+    first = world.start()
+    world.loaders[world.levels[0][0]].thread.join()
+    del world.builtOn[:]
+    second = world.start(world.index)
+    assert second is not first
+    assert threading.current_thread() not in world.builtOn
+
+def test_moving_on_drops_stale_loaders (level_file):
+    world = make_world(level_file, 4)
+    world.start()
+    assert world.levels[1][0] in world.loaders
+    world.start(3)
+    assert sorted(world.loaders) == [world.levels[3][0]]
+
+def test_no_preloading_builds_on_start (level_file):
+    world = make_world(level_file, 2, preloading=False)
+    world.start()
+    assert world.loaders == {}
+    assert world.builtOn == [threading.current_thread()]